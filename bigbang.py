@@ -12,15 +12,18 @@ import re
 import subprocess
 import ipaddress
 import glob
+import shutil
+import fcntl
+import tempfile
 import random
 import yaml # type: ignore
 import psutil # type: ignore
 import time
 import string
 import socket
-from threading import Thread
+from threading import Thread, Event
 from datetime import datetime
-from contextlib import ExitStack
+from contextlib import ExitStack, contextmanager
 
 from subprocess import CalledProcessError
 from typing import List, Callable, Optional, Any, Dict
@@ -33,10 +36,17 @@ import logging
 # local imports
 import out
 import bbio
+import durations
+import tfcache
+import kubeapply
+import sshmux
 import ready # local imports
+import kubeapi
 from cmdgrp import CommandGroup
 from capcalc import HazelcastContainers, ChaosMeshContainers
 from run import runShell, runTry, runStdout, runCollect, retryRun, runIgnore
+from run import runInput, invalidateCache
+from run import arunTry, arunIgnore, runConcurrently
 from timer import Timer
 
 # Do this just to get rid of the warning when we try to read from the
@@ -90,6 +100,27 @@ minNodes        = 3
 maxpodpnode     = 32
 maxloggedcns    = 32
 
+# Charts we install are pulled once, as tarballs, into a cache shared by every
+# run, and installed from there. Once we have the versions we need, we don't
+# talk to the chart repos at all.
+chartcachedir   = os.path.expanduser("~/.cache/bigbang/charts")
+helmindexttl    = 3600 # seconds before a repo index is too old to pull from
+
+# How long stop waits for cloud LBs to go once their services are deleted
+lbdeletetimeout = 600 # seconds
+
+# Racing zones
+raceportoffset  = 100 # tunnel to each zone's API server is apiserv port + this
+racepoll        = 5   # seconds between checks on how a race is going
+zonechoicebf    = '.bigbang_zone' # in target dir; zone we last raced to
+hibernatingbf   = '.bigbang_hibernating' # in target dir while hibernating
+appliedbf       = '.bigbang_applied.json' # in target dir; see kubeapply
+
+# Warm pool of clusters
+poolportoffset  = 200 # each slot's tunnels are on our usual ports + this + slot
+poolsizelabel   = 'PoolSize'
+defpoolsize     = 2   # clusters kept ready to lease, unless my-vars says
+
 #
 # Secrets
 # 
@@ -105,6 +136,9 @@ p.add_argument('-c', '--skip-cluster-start', action="store_true",
                help="Skip checking to see if cluster needs to be started.")
 p.add_argument('-e', '--empty-nodes', action="store_true",
                help="Unload k8s cluster only. Used with stop.")
+p.add_argument('-f', '--fast', action="store_true",
+               help="Delete only the load balancers and their DNS records, "
+               "then destroy the cluster. Used with stop.")
 p.add_argument('-g', '--target', action="store",
                help="Force cloud target to specified value.")
 p.add_argument('-t', '--test', action='store', metavar='RUNS', type=int,
@@ -113,9 +147,26 @@ p.add_argument('-T', '--local-test', action='store_true',
                help="Run test as local-only test (not client/server)")
 p.add_argument('-z', '--zone', action="store",
                help="Force zone/region to specified value.")
+p.add_argument('-r', '--race', action='store', metavar='ZONES', type=int,
+               help="Provision in this many preferred zones at once, keep "
+               "whichever cluster is ready first, and destroy the rest.")
+p.add_argument('--race-slot', action='store', type=int,
+               help=argparse.SUPPRESS)
+p.add_argument('-s', '--slot', action='store', type=int,
+               help="Use the pool cluster in this slot (see lease).")
+p.add_argument('-k', '--pool-size', action='store', type=int,
+               help=f"Keep this many clusters ready to lease (default from "
+               f"{poolsizelabel}, or {defpoolsize}).")
 p.add_argument('command',
-               choices = ['start', 'stop'],
-               help="""Start/stop the demo environment.""")
+               choices = ['start', 'stop', 'lease', 'return', 'hibernate',
+                          'resume'],
+               help="""Start/stop the demo environment, or lease a cluster
+               from the warm pool and start on it, and return it when done.
+               Hibernate empties the cluster and scales its nodes to zero,
+               leaving everything else in place, and resume scales them back
+               up.""")
+p.add_argument('--provision-only', action="store_true",
+               help=argparse.SUPPRESS)
 p.add_argument('-P', '--progmeter-test', action="store_true",
                help=argparse.SUPPRESS)
 
@@ -124,20 +175,44 @@ ns = p.parse_args()
 # Options which can only be used with stop
 if ns.command != 'stop' and ns.empty_nodes:
     p.error("empty_nodes is only used with stop")
+if ns.command != 'stop' and ns.fast:
+    p.error("fast is only used with stop")
+if ns.fast and ns.empty_nodes:
+    p.error("fast destroys the cluster, so can't be used with empty_nodes")
 
-# Options which can only be used with start
+# Options which can only be used with start (test is also passed on by lease)
 if ns.command != 'start':
     v = vars(ns)
-    for switch in {'skip_cluster_start', 'test'}:
+    for switch in {'skip_cluster_start', 'test', 'race'}:
+        if switch == 'test' and ns.command == 'lease':
+            continue
         if switch in v and v[switch]:
             p.error(f"{switch} is only used with start")
 
-if ns.command not in ('start', 'stop'):
-    p.error('Command can only be start or stop')
+if ns.command not in ('start', 'stop', 'lease', 'return', 'hibernate',
+                      'resume'):
+    p.error('Command can only be start, stop, lease, return, hibernate or '
+            'resume')
+
+if ns.command == 'lease' and (ns.slot is not None or ns.zone or ns.race):
+    p.error('lease chooses a slot from the pool, in the default zone')
+
+if ns.slot is not None and ns.race:
+    p.error('Pool clusters cannot be raced')
+
+if ns.provision_only and ns.slot is None:
+    p.error('provision_only needs a slot')
 
 if ns.local_test and not ns.test:
     p.error('Local-test mode can only be used with test mode')
 
+if ns.race and (ns.zone or ns.skip_cluster_start):
+    p.error('race chooses the zone and starts the cluster itself, so cannot '
+            'be used with zone or skip_cluster_start')
+
+if ns.race_slot is not None and not ns.zone:
+    p.error('race_slot needs a zone')
+
 #
 # Read the configuration yaml for _this_ Python script ("my-vars.yaml"). This
 # is the main configuration file one needs to edit. There is a 2nd config file,
@@ -164,6 +239,26 @@ def requireKey(key: str, d: dict[str, Any]):
     if key not in d:
         raise KeyError(key)
 
+# Pool clusters each have a working directory of their own under the
+# target's, which also holds everything else we know about them
+def pool_tfdir(target: str, slot: int) -> str:
+    return os.path.join(bbio.where(target), 'pool', str(slot))
+
+# Where Terraform runs for this invocation, ignoring racing (see race_slot)
+def work_dir(target: str) -> str:
+    if ns.slot is not None:
+        return pool_tfdir(target, ns.slot)
+    return bbio.where(target)
+
+# The zone we last raced to, or that a pool cluster was built in, if it still
+# has a cluster
+def chosen_zone(target: str) -> str:
+    try:
+        with open(os.path.join(work_dir(target), zonechoicebf)) as fh:
+            return fh.read().strip()
+    except OSError:
+        return ""
+
 try:
     # Email
     email = myvars['Email']
@@ -171,8 +266,9 @@ try:
     # Target
     target = ns.target if ns.target else myvars[targetlabel]
 
-    # Zone - If from myvars, take first choice from preferred list
-    zone = ns.zone if ns.zone else myvars[prefzonelabel][target][0]
+    # Zone - If not forced, take the zone we last raced to (see race_zones),
+    # or else the first choice from preferred list
+    zone = ns.zone or chosen_zone(target) or myvars[prefzonelabel][target][0]
 
     appversion        = myvars[appversionlabel] # AppVersion
     oprchartversion   = myvars[oprchartvlabel] # OprChartVersion
@@ -200,6 +296,21 @@ except KeyError as e:
     sys.exit(f"Consider running a git diff {myvarsf} to ensure no "
              "parameters have been eliminated.")
 
+if ns.race:
+    # AWS zones are regions, which must match the AWS config (see
+    # getRegionFromZone), so there's nothing to race between
+    if target == "aws":
+        p.error("race is not supported on AWS")
+    nzones = len(myvars[prefzonelabel][target])
+    if not 2 <= ns.race <= nzones:
+        p.error(f'race needs between 2 and {nzones} zones for {target}')
+
+poolsize = ns.pool_size or myvars.get(poolsizelabel, defpoolsize)
+
+if ns.slot is not None and not ns.provision_only and \
+        not os.path.isdir(pool_tfdir(target, ns.slot)):
+    p.error(f'There is no cluster in pool slot {ns.slot}')
+
 #
 # Email
 #
@@ -242,12 +353,42 @@ def getRegionFromZone(zone: str) -> str:
 
 region = getRegionFromZone(zone)
 
+# When racing, each zone gets a working directory of its own under the
+# target's, sharing its .tf files but with its own variables, lock and state
+def zone_tfdir(zone: str) -> str:
+    return os.path.join(bbio.where(target), 'zones', zone)
+
+def make_tfdir(zdir: str) -> str:
+    os.makedirs(zdir, exist_ok=True)
+    varsroot = os.path.splitext(tfvars)[0] + '_'
+    for f in glob.glob(os.path.join(bbio.where(target), '*.tf')):
+        bn = os.path.basename(f)
+        link = os.path.join(zdir, bn)
+        if not bn.startswith(varsroot) and not os.path.lexists(link):
+            os.symlink(os.path.join('..', '..', bn), link)
+    # Start from the same provider versions as the target's own directory
+    lockf = os.path.join(bbio.where(target), tfcache.lockf)
+    if os.path.exists(lockf) and not os.path.exists(
+            os.path.join(zdir, tfcache.lockf)):
+        shutil.copy(lockf, zdir)
+    return zdir
+
 # Terraform files are in a directory named for target
 tfdir = bbio.where(target)
+if ns.race_slot is not None:
+    tfdir = make_tfdir(zone_tfdir(zone))
+elif ns.slot is not None:
+    tfdir = make_tfdir(pool_tfdir(target, ns.slot))
 tf    = f"terraform -chdir={tfdir}"
 for d in [templatedir, tmpdir, tfdir]:
     assert bbio.writeableDir(d)
 
+# Share downloaded providers between targets and runs, rather than fetching
+# them all over again into each target's .terraform directory
+tfplugincache = os.path.expanduser("~/.terraform.d/plugin-cache")
+os.makedirs(tfplugincache, exist_ok=True)
+os.environ.setdefault("TF_PLUGIN_CACHE_DIR", tfplugincache)
+
 #
 # NodeCount
 #
@@ -283,6 +424,8 @@ if target == "gcp":
 codelen = min(3, len(username))
 nameprefix = username[:codelen]
 s = username + zone
+if ns.slot is not None:
+    s += f'pool{ns.slot}' # pool clusters mustn't collide with ours, or others
 octet = int(hashlib.sha256(s.encode('utf-8')).hexdigest(), 16) % 256
 code = str(octet).zfill(3)
 shortname = nameprefix + code
@@ -330,6 +473,9 @@ else:
 
 assert len(instanceTypes) == 1
 
+# Learn how long things take separately for each shape of cluster
+durations.configure(f'{target}:{instanceTypes[0]}:{nk8snodes}')
+
 #
 # Create some names for some cloud resources we'll need
 #
@@ -441,6 +587,17 @@ class Services:
 
 svcs = Services(test_mode=(ns.test and ns.test > 0))
 
+# Each racing zone and pool cluster needs a tunnel of its own to its API
+# server, and a kubeconfig of its own pointing at it. Leased clusters can be
+# in use at the same time, so their service tunnels need ports of their own
+# too.
+if ns.race_slot is not None:
+    svcs.get('apiserv').lcl_port += raceportoffset + ns.race_slot
+elif ns.slot is not None:
+    for svc in svcs.svcs.values():
+        svc.lcl_port += poolportoffset + ns.slot
+    os.environ['KUBECONFIG'] = os.path.join(tfdir, 'kubeconfig')
+
 def random_string(length: int) -> str:
     chars = string.ascii_letters + string.digits
     return ''.join(random.choices(chars, k = length))
@@ -520,26 +677,38 @@ def removeOldVersions(similar: str) -> None:
         print(f"Removing old parameterised file {f}")
         os.remove(f)
 
-def parameteriseTemplate(template: str, tmp_dir: str, varsDict: dict,
-                         undefinedOk: set[str] = set()) -> tuple[bool, str]:
-    yamltmp, root, ext = convert_template_to_tmpname(template, tmp_dir)
-
-    # if we're writing a Terraform file, make sure to clean up older,
-    # similar-looking Terraform files as these will cause Terraform to fail
-    if ext == "tf":
-        similar = f"{tmp_dir}/{root}*{ext}"
-        removeOldVersions(similar)
-
-    # render the template with the parameters, and capture result in memory
+# One Jinja environment for the whole run. It keeps compiled templates in
+# memory, recompiling them if their files change, and keeps their bytecode in
+# a per-user cache directory across runs.
+jinjaenv = jinja2.Environment(loader=jinja2.FileSystemLoader(templatedir),
+                              trim_blocks=True, lstrip_blocks=True,
+                              undefined=jinja2.DebugUndefined,
+                              bytecode_cache=jinja2.FileSystemBytecodeCache())
+
+# Variables each template refers to, by template filename and mtime
+templatevars: dict[tuple[str, float], set[str]] = {}
+
+def getTemplateVars(template: str) -> set[str]:
+    assert jinjaenv.loader is not None
+    source, filename, _ = jinjaenv.loader.get_source(jinjaenv, template)
+    assert filename is not None
+    key = (filename, os.path.getmtime(filename))
+    if key not in templatevars:
+        templatevars[key] = find_undeclared_variables(jinjaenv.parse(source))
+    return templatevars[key]
+
+# Render the template with the parameters, and capture result in memory
+def renderTemplate(template: str, varsDict: dict,
+                   undefinedOk: set[str] = set()) -> str:
     try:
-        file_loader = jinja2.FileSystemLoader(templatedir)
-        env = jinja2.Environment(loader=file_loader, trim_blocks=True,
-                                 lstrip_blocks=True,
-                                 undefined=jinja2.DebugUndefined)
-        t = env.get_template(template)
+        t = jinjaenv.get_template(template)
         output = t.render(varsDict)
-        ast = env.parse(output)
-        undefined = find_undeclared_variables(ast)
+        # Usually everything the template refers to is defined. If not, the
+        # missing variables may be in branches we didn't take, so look for
+        # any that DebugUndefined left behind in the output.
+        undefined = getTemplateVars(template) - varsDict.keys() - undefinedOk
+        if undefined:
+            undefined = find_undeclared_variables(jinjaenv.parse(output))
         if len(undefined - undefinedOk) > 0:
             raise jinja2.UndefinedError(f'Undefined vars in {template}: '
                                         f'{undefined}; undefinedOK'
@@ -547,7 +716,19 @@ def parameteriseTemplate(template: str, tmp_dir: str, varsDict: dict,
     except jinja2.TemplateNotFound as e:
         print(f"Couldn't read {template} from {templatedir} due to {e}")
         raise
+    return output
+
+def parameteriseTemplate(template: str, tmp_dir: str, varsDict: dict,
+                         undefinedOk: set[str] = set()) -> tuple[bool, str]:
+    yamltmp, root, ext = convert_template_to_tmpname(template, tmp_dir)
+
+    # if we're writing a Terraform file, make sure to clean up older,
+    # similar-looking Terraform files as these will cause Terraform to fail
+    if ext == "tf":
+        similar = f"{tmp_dir}/{root}*{ext}"
+        removeOldVersions(similar)
 
+    output = renderTemplate(template, varsDict, undefinedOk)
     changed = replaceFile(yamltmp, output)
     return changed, yamltmp
 
@@ -555,7 +736,11 @@ class MissingTerraformOutput(Exception):
     pass
 
 def get_output_vars() -> dict:
-    x = json.loads(runCollect(f"{tf} output -json".split()))
+    # Reuse the outputs from last time unless the state has changed since
+    if (x := tfcache.cached_outputs(tfdir)) is None:
+        version = tfcache.state_version(tfdir)
+        x = json.loads(runCollect(f"{tf} output -json".split()))
+        tfcache.cache_outputs(tfdir, version, x)
 
     env = {k: v["value"] for k, v in x.items()}
     if not env:
@@ -584,8 +769,12 @@ def updateKubeConfig() -> None:
     if target == "aws":
         runStdout(f"aws eks update-kubeconfig --name {clustname}".split())
     elif target == "az":
+        # Unlike the others, az doesn't look at KUBECONFIG by itself
+        kubecfg = []
+        if "KUBECONFIG" in os.environ:
+            kubecfg = ["--file", os.environ["KUBECONFIG"].split(':')[0]]
         runStdout(f"az aks get-credentials --resource-group {resourcegrp} "
-                  f"--name {clustname} --overwrite-existing".split())
+                  f"--name {clustname} --overwrite-existing".split() + kubecfg)
     elif target == "gcp":
         runStdout(f"gcloud container clusters get-credentials {clustname} "
                   f"--region {zone} --internal-ip".split())
@@ -656,22 +845,7 @@ def waitUntilPodsReady(namespace: str, mincontainers: int = 0) -> float:
     return safeDivide(numer, denom)
 
 def waitUntilDeploymentsAvail(namespace: str, minreplicas: int = 0) -> float:
-    numer = 0
-    denom = 0
-    namesp = f" --namespace {namespace}" if namespace else ""
-    r = runTry(f"{kube}{namesp} get deployments -o json".split())
-    if r.returncode == 0:
-        deps = json.loads(r.stdout)['items']
-        for dep in deps:
-            reptotal = dep["spec"]["replicas"]
-            repready = 0
-            if "status" in dep:
-                status = dep["status"]
-                if "readyReplicas" in status:
-                    repready = dep["status"]["readyReplicas"]
-            assert repready <= reptotal
-            numer += repready
-            denom += reptotal
+    numer, denom = ready.summarize_deployments(namespace)
     if minreplicas:
         denom = min(minreplicas, denom)
     return safeDivide(numer, denom)
@@ -686,11 +860,10 @@ def get_lbs(load_balancer_names: list[str], namespace: str) -> dict[str, str]:
     found_lbs: dict[str, str] = {}
 
     # Get only load balancers
-    r = runTry(f"{kube} -n {namespace} get svc -ojson".split())
-    if r.returncode != 0:
+    items = ready.list_services(namespace)
+    if items is None:
         return found_lbs
 
-    items = json.loads(r.stdout)["items"]
     for item in items:
         # Spec section
         #
@@ -761,34 +934,31 @@ def waitUntilApiServerResponding() -> float:
         pass
     return 0.0
 
-# A class for recording ssh tunnels
+# A class for recording ssh tunnels. Each is a port forward on the one ssh
+# connection we keep to its bastion, which sshmux watches over, restoring the
+# forward if it goes and timing probes along its path (see sshmux).
 class Tunnel:
     def __init__(self, shortname: str, bastionIp: ipaddress.IPv4Address,
-                 lPort: int, rAddr: str, rPort: int):
+                 lPort: int, rAddr: str, rPort: int, tls: bool = False):
         self.shortname = shortname
+        self.tls = tls # so that sshmux can time handshakes through us
         self.bastion = bastionIp
         self.lport = lPort
         self.raddr = rAddr
         self.rport = rPort
-        self.command = ("ssh -N -L{p}:{a}:{k} {bu}@{b}"
-                        .format(p=lPort, a=rAddr, k=rPort, bu=bastionuser,
-                                b=bastionIp))
-        self.p: Optional[subprocess.Popen] = None
+        self.spec = f'{lPort}:{rAddr}:{rPort}'
+        self.master: Optional[sshmux.Master] = None
 
     def __enter__(self):
-        print(self.command)
-        self.p = subprocess.Popen(self.command.split(),
-                                  stdout=subprocess.DEVNULL,
-                                  stderr=subprocess.STDOUT)
-        assert self.p is not None
+        self.master = sshmux.forward(bastionuser, str(self.bastion),
+                                     self.spec, self.shortname, self.tls)
         out.announce("Created tunnel " + str(self))
         return self
 
     def __exit__(self, *_):
         out.announce("Terminating tunnel " + str(self))
-        assert self.p is not None
-        self.p.terminate()
-        self.p = None
+        sshmux.cancel(str(self.bastion), self.spec)
+        self.master = None
         return False
 
     def __str__(self):
@@ -796,12 +966,36 @@ class Tunnel:
         if len(self.raddr) < 16:
             tgtname = "[{n}]{h}".format(n = self.shortname, h = self.raddr)
         s = '{l} -> {ra}:{rp}'.format(l=self.lport, ra=tgtname, rp=self.rport)
-        if self.p:
-            s += ' (PID {})'.format(self.p.pid)
+        if self.master and self.master.p:
+            s += ' (via PID {})'.format(self.master.p.pid)
         return s
 
-# A class for logging pods
+# With --prefix and --timestamps, kubectl logs lines look like
+# '[pod/NAME/CONTAINER] TIMESTAMP MESSAGE', where the timestamp is RFC 3339 in
+# UTC with up to nine digits of fraction. Returns the source and the
+# timestamp, with its fraction padded out so that timestamps compare as
+# strings, or None for any other line.
+def parse_log_line(line: str) -> Optional[tuple[str, str]]:
+    if not line.startswith('[') or (end := line.find('] ')) < 0:
+        return None
+    ts = line[end + 2:].split(' ', 1)[0]
+    if len(ts) < 20 or not ts.endswith('Z'):
+        return None
+    secs, _, frac = ts[:-1].partition('.')
+    return line[:end + 1], f'{secs}.{frac.ljust(9, "0")}Z'
+
+# A class for logging pods. kubectl logs -f exits from time to time (more so
+# while chaos is partitioning the cluster), and we start it again from the
+# last timestamp we wrote, rather than from the start of the log. The
+# API server only takes whole seconds for that, so we get the rest of that
+# second again, and drop whatever we've already written of it.
 class PodLog:
+    min_backoff = 1.0 # seconds between restarts of kubectl
+    max_backoff = 30.0
+    # Seconds a source (a pod's container) can go without logging before we
+    # stop resuming from its last line: it may have finished, or gone
+    quiet_after = 60.0
+
     def __init__(self,
                  namespace: str,
                  name: str,
@@ -810,9 +1004,15 @@ class PodLog:
         self.name = name
         self.pod_selector = pod_selector
         self.filename = tmp_filename(name, "log")
-        self.fh = open(self.filename, "a")
+        self.fh = open(self.filename, "a", buffering=1) # by line
         self.thread: Optional[Thread] = None
+        self.p: Optional[subprocess.Popen] = None
         self.terminate = False
+        self.stopped = Event() # for waking up from a backoff
+        # source -> (last timestamp written, lines written with it)
+        self.written: dict[str, tuple[str, set[str]]] = {}
+        self.heard: dict[str, float] = {} # source -> when we last read it
+        self.ended = 0.0 # when kubectl last exited
         container_switch = "--all-containers"
         if container:
             container_switch = f'--container={container}'
@@ -823,39 +1023,84 @@ class PodLog:
         self.thread = Thread(target=self.__log_forever_thread)
         self.thread.start()
 
+    # Every source is resumed from the same time, so it has to be the
+    # earliest of those still logging when kubectl exited. Sources which had
+    # gone quiet by then don't hold it back: they've nothing more to send from
+    # before it, and the boundary dedup covers anything from their last second.
+    # If they've all gone quiet, we resume from the last line of any of them.
+    def since_time(self) -> str:
+        if not self.written:
+            return ""
+        active = [ts for source, (ts, _) in self.written.items()
+                  if self.heard[source] >= self.ended - self.quiet_after]
+        ts = min(active) if active else \
+                max(ts for ts, _ in self.written.values())
+        return f'--since-time={ts[:19]}Z'
+
+    # Whether we've written this line already, noting it if not
+    def seen(self, line: str) -> bool:
+        if not (parsed := parse_log_line(line)):
+            return False
+        source, ts = parsed
+        self.heard[source] = time.time()
+        last, lines = self.written.get(source, ("", set()))
+        if ts < last or (ts == last and line in lines):
+            return True
+        if ts > last:
+            lines = set()
+            self.written[source] = (ts, lines)
+        lines.add(line)
+        return False
+
     def __log_forever_thread(self):
-        p = subprocess.Popen(self.command.split(),
-                             stdout=self.fh,
-                             stderr=subprocess.STDOUT)
-        while True:
-            subprocess_terminated = False
-            return_code = 0
-            try:
-                return_code = p.wait(timeout=2) # wait for termination
-                subprocess_terminated = True
-            except subprocess.TimeoutExpired: # timeout completed
-                pass
+        backoff = self.min_backoff
+        while not self.terminate:
+            started = time.time()
+            p = subprocess.Popen(self.command.split() +
+                                 self.since_time().split(),
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT,
+                                 text=True)
+            self.p = p
+            if self.terminate: # asked to stop before it had a chance
+                p.terminate()
+            assert p.stdout is not None
+            for line in p.stdout:
+                if not self.seen(line):
+                    self.fh.write(line)
+            return_code = p.wait()
+            self.ended = time.time()
 
             if self.terminate: # someone wants us to stop
-                if not subprocess_terminated:
-                    p.terminate() # terminate child process
                 break
 
-            if subprocess_terminated:
-                msg=('Previous log ended w/ RC={rc}. '
-                     'Log restarting @{ts}: {me}'.format(
-                         rc=return_code,
-                         ts=str(datetime.now().time()),
-                         me=str(self)))
-                assert not self.fh.closed
-                self.fh.write(msg + "\n") # write it to the log
-                p = subprocess.Popen(self.command.split(),
-                                     stdout=self.fh,
-                                     stderr=subprocess.STDOUT)
-                # Continue loop with new subprocess
+            msg=('Previous log ended w/ RC={rc}. '
+                 'Log restarting @{ts}: {me}'.format(
+                     rc=return_code,
+                     ts=str(datetime.now().time()),
+                     me=str(self)))
+            assert not self.fh.closed
+            self.fh.write(msg + "\n") # write it to the log
+
+            # If kubectl can't even get going (say the API server is out of
+            # reach), don't keep trying as fast as it fails
+            if time.time() - started > self.max_backoff:
+                backoff = self.min_backoff # it was running fine
+            self.stopped.wait(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+            # Continue loop with new subprocess
+
+    # Returns once the thread has written everything it's going to
+    def stop(self) -> None:
+        self.terminate = True
+        self.stopped.set()
+        if self.p and self.p.poll() is None:
+            self.p.terminate()
+        if self.thread and self.thread.is_alive():
+            self.thread.join()
 
     def __del__(self):
-        self.terminate = True
+        self.stop()
         out.announce("Terminating log capture " + str(self))
         assert self.fh is not None
         self.fh.close()
@@ -867,7 +1112,7 @@ class PodLog:
         return self
 
     def __exit__(self, *_):
-        self.terminate = True
+        self.stop()
         return False
 
 # Input dictionary is the output variables from Terraform.
@@ -893,9 +1138,12 @@ def setup_k8s_api_tunnel(bastion_ip: ipaddress.IPv4Address,
 
     # Start up the tunnel to the Kubernetes API server
     return Tunnel("k8s-apiserver", bastion_ip, svcs.get_lcl_port("apiserv"),
-                  k8s_server_name, svcs.get_rmt_port("apiserv"))
+                  k8s_server_name, svcs.get_rmt_port("apiserv"),
+                  svcs.get("apiserv").tls)
 
-def terraform_start() -> None:
+# nodes is the number of worker nodes to run; only GKE can be scaled to zero
+# this way (see hibernate_cluster)
+def terraform_start(nodes: int = nk8snodes) -> None:
     # Get my public IP and SSH public key
     #
     my_pub_ip = get_my_pub_ip()
@@ -909,7 +1157,7 @@ def terraform_start() -> None:
              "MyCIDR":              mySubnetCidr,
              "MyPublicIP":          my_pub_ip,
              'NetwkName':           netwkname,
-             "NodeCount":           nk8snodes,
+             "NodeCount":           nodes,
              "SmallInstanceType":   smallInstanceType,
              "SshPublicKey":        my_ssh_pub_key,
              "Region":              region,
@@ -926,49 +1174,77 @@ def terraform_start() -> None:
         tfenv["GcpProjectId"] = gcpproject
         tfenv["GcpAccount"] = gcpaccount
 
-    parameteriseTemplate(tfvars, tfdir, tfenv)
+    _, varsfile = parameteriseTemplate(tfvars, tfdir, tfenv)
+
+    # Only init if the providers or modules we need may have changed
+    if tfcache.needs_init(tfdir, varsfile):
+        out.announce('running terraform init')
+        runStdout(f"{tf} init -upgrade -input=false".split())
+        tfcache.record_init(tfdir, varsfile)
+    else:
+        print('Terraform providers and modules unchanged; skipping init')
+
+    # If neither our configuration nor the state has changed since our last
+    # apply, the only thing that can have changed is the cloud itself. Check
+    # for that with a refresh-only plan, which is much faster than an apply,
+    # and don't bother at all if we checked very recently.
+    if not tfcache.needs_apply(tfdir):
+        if tfcache.recently_verified(tfdir):
+            print('Terraform configuration unchanged and recently applied; '
+                  'skipping apply')
+            return
+        out.announce('Terraform configuration unchanged; checking for drift')
+        rc = runTry(f"{tf} plan -refresh-only -detailed-exitcode "
+                    "-input=false".split()).returncode
+        if rc == 0:
+            tfcache.record_apply(tfdir)
+            return
+        print('Terraform infrastructure has drifted; applying')
 
-    out.announce('running terraform init & apply')
-    runStdout(f"{tf} init -upgrade -input=false".split())
+    out.announce('running terraform apply')
     runStdout(f"{tf} apply -auto-approve -input=false".split())
+    tfcache.record_apply(tfdir)
 
-def wait_until_k8s_is_ready() -> None:
+# With apiServerOnly, return as soon as we can talk to the API server, which
+# is enough to delete things
+def wait_until_k8s_is_ready(apiServerOnly: bool = False) -> None:
     # Now that the tunnel is in place, update our kubecfg with the address to
     # the tunnel, keeping everything else in place
     updateKubeConfig()
 
     # Ensure that we can talk to the api server
     out.announce("Waiting for api server to respond")
-    out.spinWait(waitUntilApiServerResponding)
+    out.spinWait(waitUntilApiServerResponding, 'api server')
+
+    # From here on, read from the API server directly rather than through
+    # kubectl, and answer readiness questions from watch streams
+    kubeapi.connect()
+    ready.start_watching()
+    if apiServerOnly:
+        return
 
     # Don't continue until all nodes are ready
     out.announce("Waiting for nodes to come online")
-    out.spinWait(lambda: waitUntilNodesReady(nk8snodes))
+    out.spinWait(lambda: waitUntilNodesReady(nk8snodes), 'k8s nodes')
 
     # Don't continue until all K8S system pods are ready
     out.announce("Waiting for K8S system pods to come online")
-    out.spinWait(lambda: waitUntilPodsReady("kube-system"))
+    out.spinWait(lambda: waitUntilPodsReady("kube-system"),
+                 'kube-system pods')
 
 # Pods sometimes get stuck in Terminating phase after a helm upgrade.
 # Kill these off immediately to save time and they will restart quickly.
 def killAllTerminatingPods(namespace: str) -> None:
-    lines = runCollect(f"{kube} -n {namespace} get pods "
-                       "--no-headers".split()).splitlines()
-    for line in lines:
-        col = line.split()
-        name = col[0]
-        status = col[2]
-        if status == "Terminating":
-            r = runTry(f"{kube} -n {namespace} delete pod {name} "
-                       "--grace-period=60".split())
-            if r.returncode == 0:
-                print(f"Cleaning up terminating pod {name}")
+    for name in ready.terminating_pod_names(namespace):
+        if kubeapi.delete_item('pods', name, namespace, grace_period=60):
+            print(f"Cleaning up terminating pod {name}")
+    ready.invalidate()
 
 def kube_force_delete_all_pods_for_selector(namespace: str,
                                             selector: str) -> None:
     out.announce(f"Force-deleting all pods for {selector}")
-    runStdout(f"{kube} -n {namespace} delete pod -l{selector} --force "
-              "--grace-period=0".split())
+    kubeapi.delete_items('pods', namespace, selector, grace_period=0)
+    ready.invalidate()
 
 # We run this command in 'delete' mode to get rid of the DNS record sets right
 # before shutdown. Technically it shouldn't be needed for AWS or GCP, both of
@@ -991,7 +1267,12 @@ def set_dns_for_lbs(zid: str, # Zone ID
                 'Comment': 'DNS CNAME records',
                 'Changes': []
                 }
-    # for Azure & GCP, we will run commands as we go
+    # for Azure & GCP, we run the commands for each record set concurrently
+    async def replace_record_set(delcmd: str, addcmd: str) -> None:
+        await arunTry(delcmd.split())
+        if not delete:
+            await arunIgnore(addcmd.split())
+    updates = []
 
     for svcname, host in lbs.items():
         assert svcname in svcs.get_clust_svc_names()
@@ -1010,25 +1291,19 @@ def set_dns_for_lbs(zid: str, # Zone ID
         elif target == 'az':
             # Azure uses IP addresses for LBs, so we use an A record. Azure
             # wants us to run a command for each update
-            cmd = (f'az network private-dns record-set a delete '
-                   f'-g {resourcegrp} -n {svcname} -z {zid} -y')
-            runTry(cmd.split())
-            if not delete:
-                cmd = (f'az network private-dns record-set a create '
-                       f'-g {resourcegrp} -n {svcname} -z {zid} --ttl {ttl}')
-                cmd = (f'az network private-dns record-set a add-record '
-                       f'-g {resourcegrp} -n {svcname} -z {zid} -a {host}')
-                runIgnore(cmd.split())
+            delcmd = (f'az network private-dns record-set a delete '
+                      f'-g {resourcegrp} -n {svcname} -z {zid} -y')
+            addcmd = (f'az network private-dns record-set a add-record '
+                      f'-g {resourcegrp} -n {svcname} -z {zid} -a {host}')
+            updates.append(replace_record_set(delcmd, addcmd))
         elif target == 'gcp':
             # GCP uses IP addresses for LBs, so we use an A record. GCP wants
             # us to run a command for each update.
-            cmd = (f'gcloud dns record-sets delete {fqn} --zone={zid} '
-                   '--type=A')
-            runTry(cmd.split())
-            if not delete:
-                cmd = (f'gcloud dns record-sets create {fqn} --zone={zid} '
-                       f'--type=A --rrdatas={host} --ttl={ttl}')
-                runIgnore(cmd.split())
+            delcmd = (f'gcloud dns record-sets delete {fqn} --zone={zid} '
+                      '--type=A')
+            addcmd = (f'gcloud dns record-sets create {fqn} --zone={zid} '
+                      f'--type=A --rrdatas={host} --ttl={ttl}')
+            updates.append(replace_record_set(delcmd, addcmd))
 
     if target == 'aws':
         batchfn = tmp_filename('crrs_batch_aws', 'json')
@@ -1036,45 +1311,51 @@ def set_dns_for_lbs(zid: str, # Zone ID
         runIgnore(('aws route53 change-resource-record-sets --hosted-zone-id '
                    f'{zid} --change-batch file://{batchfn} '
                    '--no-cli-pager').split())
-    # Nothing more to do for Azure or GCP
+    elif updates:
+        runConcurrently(*updates)
 
-def wait_for_chaosmesh_pods() -> None:
-    namespace = chaos_namespace
+# Readiness goals for each namespace. These can be waited on one group at a
+# time, or all together with wait_for_goals.
+def chaosmesh_pod_goals() -> list[out.Goal]:
     cm_containers = ChaosMeshContainers()
-
-    out.announce(f"Waiting for {namespace} pods to be ready")
     expectedContainers = cm_containers.numberOfContainers(nk8snodes,
                                                           nhzclients)
-    out.spinWait(lambda: waitUntilPodsReady(chaos_namespace,
-                                            expectedContainers))
+    return [(f'{chaos_namespace} pods',
+             lambda: waitUntilPodsReady(chaos_namespace, expectedContainers)),
+            (f'{chaos_namespace} deployments',
+             lambda: waitUntilDeploymentsAvail(chaos_namespace))]
 
-    out.announce(f"Waiting for {namespace} deployments to be available")
-    out.spinWait(lambda: waitUntilDeploymentsAvail(chaos_namespace))
-
-def wait_for_hazelcast_pods() -> None:
+def hazelcast_pod_goals() -> list[out.Goal]:
     hz_containers = HazelcastContainers()
-
-    out.announce(f"Waiting for {hz_namespace} pods to be ready")
     expectedContainers = hz_containers.numberOfContainers(nhzmembers,
                                                           nhzclients)
-    out.spinWait(lambda: waitUntilPodsReady(hz_namespace, expectedContainers))
+    return [(f'{hz_namespace} pods',
+             lambda: waitUntilPodsReady(hz_namespace, expectedContainers)),
+            (f'{hz_namespace} deployments',
+             lambda: waitUntilDeploymentsAvail(hz_namespace))]
 
-    out.announce(f"Waiting for {hz_namespace} deployments to be available")
-    out.spinWait(lambda: waitUntilDeploymentsAvail(hz_namespace))
-
-def wait_for_hazelcast_svcs() -> None:
-    # now the load balancers need to be running with their IPs assigned
+def hazelcast_svc_goals() -> list[out.Goal]:
+    # the load balancers need to be running with their IPs assigned
     svcnames = list(svcs.get_clust_svc_names())
-    svcnamesstr = ", ".join(svcnames)
-    out.announce(f'Waiting for {hz_namespace} LBs to launch: {svcnamesstr}')
-    out.spinWait(lambda: waitUntilLoadBalancersUp(svcnames, hz_namespace))
+    if not svcnames:
+        return []
+    return [(f'{hz_namespace} LBs',
+             lambda: waitUntilLoadBalancersUp(svcnames, hz_namespace))]
+
+def wait_for_goals(goals: list[out.Goal]) -> None:
+    out.announce('Waiting for ' + ', '.join(label for label, _ in goals))
+    out.spinWaitMulti(goals)
+
+def wait_for_hazelcast_pods() -> None:
+    wait_for_goals(hazelcast_pod_goals())
 
 def wait_for_k8s_svcs() -> None:
     # now the load balancers need to be running with their IPs assigned
     svcnames = list(svcs.get_k8s_svc_names())
     svcnamesstr = ", ".join(svcnames)
     out.announce(f'Waiting for LBs to launch: {svcnamesstr}')
-    out.spinWait(lambda: waitUntilLoadBalancersUp(svcnames, hz_namespace))
+    out.spinWait(lambda: waitUntilLoadBalancersUp(svcnames, hz_namespace),
+                 'load balancers')
 
 def create_tunnels_to_k8s_svcs(bastion_addr: str) -> tuple[list[Tunnel],
                                                            dict[str, str]]:
@@ -1091,7 +1372,7 @@ def create_tunnels_to_k8s_svcs(bastion_addr: str) -> tuple[list[Tunnel],
         assert svcname in lbs
         tun = Tunnel(svcname, ipaddress.IPv4Address(bastion_addr),
                      svcs.get_lcl_port(svcname), lbs[svcname],
-                     svcs.get_rmt_port(svcname))
+                     svcs.get_rmt_port(svcname), svcs.get(svcname).tls)
         tuns.append(tun)
 
     return tuns, lbs
@@ -1104,15 +1385,9 @@ def convert_zulu_time_to_timestamp(datetimestr: str) -> float:
     return datetime.timestamp(datetime.fromisoformat(datetimestr))
 
 def k8s_secrets_list(namespace: str):
-    installed_secrets = {}
-    x = runCollect([kube, '-n', namespace, 'get', 'secrets',
-                    '-o=jsonpath={range $.items[*].metadata}'
-                    '{.name}{" "}{.creationTimestamp}{" "}{end}'])
-    if x:
-        s = x.split()
-        z = zip(s[0::2], s[1::2])
-        installed_secrets = {x: y for x, y in z}
-    return installed_secrets
+    return {s['metadata']['name']: s['metadata']['creationTimestamp']
+            for s in kubeapi.list_items('secrets', namespace,
+                                        metadata_only=True)}
 
 def k8s_secrets_create(namespace: str,
                        secrets_to_add: dict[str, dict[str, str]]) -> dict[str, str]:
@@ -1154,8 +1429,7 @@ def k8s_secrets_create(namespace: str,
 
             print(f'Replacing secret "{secret_to_add_name}" '
                   f'with newer version of {file}')
-            runIgnore(f'{kube} -n {namespace} delete secret '
-                      f'{secret_to_add_name}'.split())
+            kubeapi.delete_item('secrets', secret_to_add_name, namespace)
         else:
             print(f'Installing secret "{secret_to_add_name}" from {file}')
 
@@ -1168,18 +1442,16 @@ def k8s_secrets_create(namespace: str,
 
     return env
 
+# These don't wait for the objects to go: nothing we need to wait for depends
+# on them.
 def k8s_secrets_delete(namespace: str):
-    installed_secrets = k8s_secrets_list(namespace)
-    for secret in installed_secrets:
-        runStdout(f'{kube} -n {namespace} delete secret {secret}'.split())
+    if names := kubeapi.delete_items('secrets', namespace):
+        print(f'Deleted secrets in {namespace}: {", ".join(names)}')
 
 def k8s_pvc_delete(namespace: str):
-    pvcs = json.loads(runCollect([kube, '-n', namespace, 'get',
-                                  'pvc', '-ojson']))
-    for pvc in pvcs['items']:
-        pvcname = pvc['metadata']['name']
-        runStdout(f'{kube} -n {namespace} delete pvc {pvcname} '
-                  '--grace-period=0 --force'.split())
+    if names := kubeapi.delete_items('persistentvolumeclaims', namespace,
+                                     grace_period=0):
+        print(f'Deleted PVCs in {namespace}: {", ".join(names)}')
 
 def k8s_restart(namespace: str, deployment: str, watch: bool = False):
     out.announce(f'Performing restart of {deployment}...')
@@ -1201,12 +1473,53 @@ def helmGet(namespace: str, cmd: str) -> str:
 def helmIgnore(namespace: str, cmd: str) -> None:
     runIgnore(['helm', '-n', namespace] + cmd.split())
 
-def helm_set_up_repo(namespace: str,
+def chart_tarball(module: str, version: str) -> str:
+    return os.path.join(chartcachedir, f'{charts[module]}-{version}.tgz')
+
+# Seconds since the index for the repo was last fetched
+def helm_repo_index_age(namespace: str, helm_repo_name: str) -> float:
+    cachedir = helmGet(namespace, "env HELM_REPOSITORY_CACHE")
+    try:
+        return time.time() - os.path.getmtime(
+                os.path.join(cachedir, f'{helm_repo_name}-index.yaml'))
+    except OSError:
+        return float('inf')
+
+# Make sure we have the given version of the module's chart in our cache,
+# setting up the repo and refreshing its index only if we need to
+def helm_fetch_chart(namespace: str,
                      helm_repo_name: str,
-                     helm_repo_location: str) -> None:
-    if (r := helmTry(namespace, "version")).returncode != 0:
+                     helm_repo_location: str,
+                     module: str,
+                     version: str) -> None:
+    if os.path.exists(tarball := chart_tarball(module, version)):
+        print(f'Using cached chart {tarball}')
+        return
+
+    if helmTry(namespace, "version").returncode != 0:
         sys.exit("Unable to run helm. Is it installed? Failing out.")
 
+    # Pull into a directory of our own, so that a failed pull never leaves a
+    # partial tarball in the cache
+    os.makedirs(chartcachedir, exist_ok=True)
+    pulldir = tempfile.mkdtemp(dir=chartcachedir)
+    pull = (f'pull {helm_repo_name}/{charts[module]} --version {version} '
+            f'-d {pulldir}')
+    try:
+        if not (helm_repo_index_age(namespace, helm_repo_name) < helmindexttl
+                and helmTry(namespace, pull).returncode == 0):
+            helm_update_repo(namespace, helm_repo_name, helm_repo_location)
+            helmCmd(namespace, pull)
+        out.announce(f'Pulled chart {charts[module]} v{version} into '
+                     f'{chartcachedir}')
+        os.replace(os.path.join(pulldir, os.path.basename(tarball)), tarball)
+    finally:
+        shutil.rmtree(pulldir)
+
+# Refresh the index of just this repo, adding the repo if we don't have it
+def helm_update_repo(namespace: str,
+                     helm_repo_name: str,
+                     helm_repo_location: str) -> None:
     # There is a bug in helm repo list, wherein it inconsistently returns
     # nonzero error codes when there are no repos installed. So just try to
     # fast-path the common case where the repo is already installed, and
@@ -1219,7 +1532,8 @@ def helm_set_up_repo(namespace: str,
             # see if it failed. :-( If it fails, then just remove the repo and
             # re-install it.
             out.announce(f'Updating helm repo {helm_repo_name}')
-            output = helmGet(namespace, "repo update --fail-on-repo-update-fail")
+            output = helmGet(namespace, f"repo update {helm_repo_name} "
+                             "--fail-on-repo-update-fail")
             if "Update Complete. ⎈Happy Helming!⎈" in output:
                 print("Upgrade of repo succeeded")
                 return
@@ -1236,8 +1550,7 @@ def helm_set_up_repo(namespace: str,
 def helmGetNamespaces() -> list:
     n = []
     try:
-        nsl = json.loads(runCollect(f"{kube} get namespaces "
-                                    "--output=json".split()))["items"]
+        nsl = kubeapi.list_items('namespaces', metadata_only=True)
         n = [x["metadata"]["name"] for x in nsl]
     except CalledProcessError:
         print("No namespaces found.")
@@ -1253,13 +1566,15 @@ def k8s_set_context_namespace(namespace: str) -> None:
     runStdout(f'{kube} config set-context --namespace={namespace} '
               '--current'.split())
 
+# Returns once the namespace is marked for deletion; the API server carries on
+# deleting what's in it. Whatever must be gone first needs waiting on
+# separately.
 def k8s_delete_namespace(namespace: str) -> None:
     if namespace in helmGetNamespaces():
         out.announce(f"Deleting namespace {namespace}")
-        runStdout(f'{kube} delete --grace-period=60 '
-                  f'namespace {namespace}'.split())
-    runStdout(f"{kube} config set-context --namespace=default "
-              "--current".split())
+        kubeapi.delete_item('namespaces', namespace)
+        kubeapply.forget(namespace)
+        ready.invalidate()
 
 def helmGetReleases(namespace: str) -> dict:
     rls = {}
@@ -1283,88 +1598,144 @@ def helm_install_release(namespace: str, reponame: str, module: str,
     existing_chart = helmWhichChartInstalled(namespace, module)
     requested_chart = charts[module] + "-" + version # which one to install?
 
+    # Install from our chart cache if we can (see helm_fetch_chart)
+    chart = chart_tarball(module, version)
+    if not os.path.exists(chart):
+        chart = f'{reponame}/{charts[module]} --version {version}'
+
     if not existing_chart:
         out.announce("Installing {ns}/{r} v{v}"
                      .format(ns=namespace, r=releases[module], v=version))
-        helmIgnore(namespace, 'install {r} {repo}/{c} --version {v} {o}'
-                   .format(r=releases[module], repo=reponame, c=charts[module],
-                           v=version, o=options))
+        helmIgnore(namespace, 'install {r} {c} {o}'
+                   .format(r=releases[module], c=chart, o=options))
     elif existing_chart != requested_chart:
         # If the vesion of the chart has changed, then we need to upgrade
         # different version of the chart, then we have to upgrade
         out.announce("Upgrading {ns}/{r} v{v}: {oc} -> {rc}"
                      .format(ns=namespace, r=releases[module], v=version,
                              oc=existing_chart, rc=requested_chart))
-        helmIgnore(namespace, 'upgrade {r} {repo}/{c} --version {v} {o}'
-                   .format(r=releases[module], repo=reponame,
-                           c=charts[module], v=version, o=options))
+        helmIgnore(namespace, 'upgrade {r} {c} {o}'
+                   .format(r=releases[module], c=chart, o=options))
     else: # existing_chart != None and existing_chart == requested_chart
         print(f'{namespace}/{existing_chart} unchanged')
+        return
+    ready.invalidate()
 
 def kube_crd_apply(crd: str, namespace: str) -> None:
     out.announce(f'Applying CRD "{crd}"')
     runStdout(f'{kube} -n {namespace} apply -f {crd}'.split())
-
-def kube_crd_apply_templated(crd: str, namespace: str, env: dict = {}) -> None:
-    # Ignore changes, apply every time
-    # TODO: Seems like if there are no changes, we shouldn't apply?
-    _, yamltmp = parameteriseTemplate(templates[crd], tmpdir, env)
-    kube_crd_apply(yamltmp, namespace)
+    ready.invalidate()
+
+# Render the given CRD templates and apply them all in one server-side apply,
+# straight from memory. Objects we've already applied to this cluster with the
+# same content are skipped without asking the API server (see kubeapply).
+def kube_crd_apply_templated(crds: list[str], namespace: str,
+                             env: dict = {}) -> None:
+    pending = {}
+    for crd in crds:
+        if objs := kubeapply.prepare(crd, namespace,
+                                     renderTemplate(templates[crd], env)):
+            pending[crd] = objs
+    if not pending:
+        print(f'CRDs {", ".join(crds)} unchanged')
+        return
+    out.announce(f'Applying CRDs {", ".join(pending)}')
+    manifest = yaml.safe_dump_all([obj for objs in pending.values()
+                                   for obj in objs])
+    runInput(f'{kube} -n {namespace} apply --server-side --force-conflicts '
+             '--field-manager=bigbang -f -'.split(), manifest)
+    for crd, objs in pending.items():
+        kubeapply.record(crd, namespace, objs)
+    ready.invalidate()
 
 def k8s_crd_delete(filename: str, namespace: str):
     if bbio.readableFile(filename):
         out.announce(f'Deleting CRD "{filename}"')
         runTry(f'{kube} -n {namespace} delete --grace-period=60 '
                f'--ignore-not-found=true -f {filename}'.split())
-
-def k8s_crd_delete_templated(crd: str, namespace: str, env) -> None:
-    # Generate filename of tmp file where CRD lives
-    yamltmp, _, _ = convert_template_to_tmpname(templates[crd])
-    k8s_crd_delete(yamltmp, namespace)
-
-def helmUninstallRelease(namespace: str, release: str) -> None:
-    helmCmd(namespace, f"uninstall {release}")
-
-def delete_all_services(namespace: str) -> bool:
+        ready.invalidate()
+
+def k8s_crd_delete_templated(crd: str, namespace: str) -> None:
+    if not (objs := kubeapply.objects(crd, namespace)):
+        # Perhaps applied by an older bigbang, which left the rendered CRD in
+        # a tmp file
+        yamltmp, _, _ = convert_template_to_tmpname(templates[crd])
+        k8s_crd_delete(yamltmp, namespace)
+        return
+    out.announce(f'Deleting CRD "{crd}"')
+    runTry(f'{kube} -n {namespace} delete --grace-period=60 '
+           '--ignore-not-found=true'.split() +
+           [f'{kind}/{name}' for kind, name in objs])
+    kubeapply.forget(namespace, crd)
+    ready.invalidate()
+
+def delete_all_services(namespace: str) -> None:
     # Explicitly deleting services gets rid of load balancers, which eliminates
     # a race condition that Terraform is susceptible to, where the ELBs created
     # by the load balancers endure while the cluster is destroyed, stranding
     # the ENIs and preventing the deletion of the associated subnets
     # https://github.com/kubernetes/kubernetes/issues/93390
     out.announce(f"Deleting all k8s services for namespace {namespace}")
-    lbs_before: dict[str, str] = get_lbs(svcs.get_k8s_svc_names(),
-                                                  namespace)
+    lbs_before = lb_service_names(namespace)
 
     # Summarize which LBs were there before attempt to kill services
     if len(lbs_before) == 0:
         print("No LBs running before deleting all services.")
     else:
         print("Load balancers before attempt "
-              "to delete services: " + ", ".join(lbs_before.keys()))
-
-    # Destroy all services!
-    runStdout(f'{kube} -n {namespace} delete '
-              '--grace-period=60 svc --all'.split())
-    lbs_after = get_lbs(svcs.get_k8s_svc_names(), namespace)
-
-    # Indicate if any LBs remain after killing services
-    if len(lbs_after) != 0:
-        print("# WARN Load balancers running after service delete! " +
-              str(lbs_after))
-        print("# WARN This may cause dependency problems later!")
-        return False
-
-    print("No load balancers running after service delete.")
-    return True
-
-def helm_uninstall_releases_and_kill_pods(namespace: str):
-    for release, chart in helmGetReleases(namespace).items():
-        try:
-            out.announce(f"Uninstalling {namespace}/{release}")
-            helmUninstallRelease(namespace, release)
-        except CalledProcessError as e:
-            print(f"Unable to uninstall release {release}: {e}")
-    killAllTerminatingPods(namespace)
+              "to delete services: " + ", ".join(sorted(lbs_before)))
+
+    # Destroy all services! We don't wait here: see waitUntilLBServicesGone.
+    kubeapi.delete_items('services', namespace)
+    ready.invalidate()
+
+# Services of type LoadBalancer, whether or not their LB has an address yet
+def lb_service_names(namespace: str) -> set[str]:
+    return {item['metadata']['name']
+            for item in ready.list_services(namespace) or []
+            if item.get('spec', {}).get('type') == 'LoadBalancer'}
+
+# A LoadBalancer service keeps a finalizer until the cloud LB behind it has
+# been deleted, so once the services are gone, so are the LBs. Raises
+# TimeoutError if any remain at the deadline.
+def waitUntilLBServicesGone(namespaces: list[str], before: int,
+                            deadline: float) -> float:
+    remaining = sum(len(lb_service_names(n)) for n in namespaces)
+    if remaining and time.time() > deadline:
+        raise TimeoutError(f'{remaining} load balancers remain')
+    return safeDivide(max(0, before - remaining), before)
+
+# Just the LoadBalancer services
+def delete_lb_services(namespace: str) -> None:
+    if names := sorted(lb_service_names(namespace)):
+        out.announce(f"Deleting load balancers {', '.join(names)} "
+                     f"in namespace {namespace}")
+        for name in names:
+            kubeapi.delete_item('services', name, namespace)
+        ready.invalidate()
+
+def helm_uninstall_releases(namespace: str):
+    if not (releases := list(helmGetReleases(namespace))):
+        return
+    out.announce(f"Uninstalling {namespace}/{','.join(releases)}")
+    try:
+        helmCmd(namespace, f"uninstall {' '.join(releases)}")
+    except CalledProcessError as e:
+        print(f"Unable to uninstall releases {releases}: {e}")
+    ready.invalidate()
+
+# Everything we put in a namespace, and then the namespace itself. Only the
+# helm uninstall waits for anything.
+def k8s_teardown_namespace(namespace: str) -> None:
+    if namespace not in helmGetNamespaces():
+        return
+    helm_uninstall_releases(namespace)
+    # Make sure to get rid of all services, in case they weren't already
+    # removed. We need to make sure we don't leak LBs.
+    delete_all_services(namespace)
+    k8s_secrets_delete(namespace)
+    k8s_pvc_delete(namespace)
+    k8s_delete_namespace(namespace)
 
 def docker_push_latest_tag(tag: str) -> None:
     docker_repo = "robhazelcast/robhz"
@@ -1372,14 +1743,12 @@ def docker_push_latest_tag(tag: str) -> None:
     runStdout(f"docker tag {docker_repo}:latest {docker_repo}:{tag}".split())
     runStdout(f"docker push {docker_repo}:{tag}".split())
 
-def start_hz_pods_svcs(env: dict[str, str],
-                       secrets: dict[str, dict[str, str]]) -> None:
+# The start pipeline is a graph of steps, each of which runs as soon as the
+# steps it depends on are done. The work units are rough relative durations.
+def add_hz_commands(cg: CommandGroup, env: dict[str, str],
+                    secrets: dict[str, dict[str, str]]) -> None:
     docker_img_tag = random_string(8)
 
-    # Create Hazelcast namespace and set as *default namespace*
-    k8s_create_namespace(hz_namespace)
-    k8s_set_context_namespace(hz_namespace) # default namespace
-
     env |= {
             appversionlabel: appversion,
             'HzClientCount': nhzclients,
@@ -1388,52 +1757,86 @@ def start_hz_pods_svcs(env: dict[str, str],
             'LatestTag': docker_img_tag
             }
 
-    env |= k8s_secrets_create(hz_namespace, secrets)
+    # Create Hazelcast namespace and set as *default namespace*
+    def create_namespace() -> None:
+        k8s_create_namespace(hz_namespace)
+        k8s_set_context_namespace(hz_namespace) # default namespace
 
-    # Set up the Helm repo if not already done
-    helm_set_up_repo(hz_namespace, hz_helm_repo_name, hz_helm_repo_location)
+    def create_secrets() -> None:
+        env.update(k8s_secrets_create(hz_namespace, secrets))
 
-    # Now, install the Hazelcast operator
-    helm_install_release(hz_namespace, hz_helm_repo_name, operator_module,
+    # Fetch the operator chart if we don't already have it
+    def set_up_repo() -> None:
+        helm_fetch_chart(hz_namespace, hz_helm_repo_name,
+                         hz_helm_repo_location, operator_module,
                          oprchartversion)
 
-    docker_push_latest_tag(docker_img_tag)
-
-    # Apply all the Hz CRD templates
-    for crd in hz_crds:
-        kube_crd_apply_templated(crd, hz_namespace, env)
-
-    # Speed up the deployment of the updated pods by killing the old ones
-    killAllTerminatingPods(hz_namespace)
-
-    # Wait for pods and services to start up.
-    wait_for_hazelcast_pods()
-    wait_for_hazelcast_svcs()
-
-def start_chaos_pods_svcs() -> None:
-    k8s_create_namespace(chaos_namespace)
-
-    # Set up the Chaos Mesh repo if not already done
-    helm_set_up_repo(chaos_namespace, chaos_helm_repo_name,
-                     chaos_helm_repo_location)
-
-    helm_install_release(chaos_namespace, chaos_helm_repo_name,
-                         chaosmesh_module, chaoschartversion,
-                         chaosmeshoptions)
-
-    # TODO: There is a bug in chaos-mesh in the auth module, that prevents
-    # chaos-mesh from working across namespaces. This is the workaround:
-    runIgnore(f'{kube} -n {chaos_namespace} delete '
-              '--ignore-not-found=true '
-              'validatingwebhookconfigurations.admissionregistration.k8s.io '
-              'chaos-mesh-validation-auth'.split())
-
-    # Speed up the deployment of the updated pods by killing the old ones
-    killAllTerminatingPods(chaos_namespace)
-
-    # Wait for pods. There are no chaosmesh services to wait for
-    wait_for_chaosmesh_pods()
+    # Now, install the Hazelcast operator
+    def install_operator() -> None:
+        helm_install_release(hz_namespace, hz_helm_repo_name, operator_module,
+                             oprchartversion)
+
+    # Apply all the Hz CRD templates, then speed up the deployment of the
+    # updated pods by killing the old ones
+    def apply_crds() -> None:
+        kube_crd_apply_templated(hz_crds, hz_namespace, env)
+        killAllTerminatingPods(hz_namespace)
+
+    cg.add_command(create_namespace, 2, 'hz-namespace')
+    cg.add_command(create_secrets, 2, 'hz-secrets', after=['hz-namespace'])
+    cg.add_command(set_up_repo, 10, 'hz-repo', after=['hz-namespace'])
+    cg.add_command(install_operator, 10, 'hz-operator', after=['hz-repo'])
+    cg.add_command(lambda: docker_push_latest_tag(docker_img_tag), 20,
+                   'docker-push', after=['hz-namespace'])
+    cg.add_command(apply_crds, 5, 'hz-crds',
+                   after=['hz-secrets', 'hz-operator', 'docker-push'])
+
+def add_chaos_commands(cg: CommandGroup) -> None:
+    # Fetch the Chaos Mesh chart if we don't already have it. Adding and
+    # updating repos rewrites helm's list of repos, so don't run ours
+    # alongside Hazelcast's.
+    def set_up_repo() -> None:
+        helm_fetch_chart(chaos_namespace, chaos_helm_repo_name,
+                         chaos_helm_repo_location, chaosmesh_module,
+                         chaoschartversion)
+
+    def install_chaosmesh() -> None:
+        helm_install_release(chaos_namespace, chaos_helm_repo_name,
+                             chaosmesh_module, chaoschartversion,
+                             chaosmeshoptions)
+
+        # TODO: There is a bug in chaos-mesh in the auth module, that prevents
+        # chaos-mesh from working across namespaces. This is the workaround:
+        runIgnore(f'{kube} -n {chaos_namespace} delete '
+                  '--ignore-not-found=true '
+                  'validatingwebhookconfigurations.admissionregistration.k8s.io '
+                  'chaos-mesh-validation-auth'.split())
+
+        # Speed up the deployment of the updated pods by killing the old ones
+        killAllTerminatingPods(chaos_namespace)
+
+    # Wait for the Hazelcast namespace step to finish rewriting the kube
+    # context before we start reading it
+    cg.add_command(lambda: k8s_create_namespace(chaos_namespace), 2,
+                   'chaos-namespace', after=['hz-namespace'])
+    cg.add_command(set_up_repo, 10, 'chaos-repo',
+                   after=['chaos-namespace', 'hz-repo'])
+    cg.add_command(install_chaosmesh, 15, 'chaos-mesh', after=['chaos-repo'])
+
+def start_pods_svcs(env: dict[str, str],
+                    secrets: dict[str, dict[str, str]]) -> None:
+    cg = CommandGroup()
+    add_hz_commands(cg, env, secrets)
+    if ns.test:
+        add_chaos_commands(cg)
+    cg.run_commands()
+    out.spinWait(cg.ratio_done, 'start pipeline')
+    cg.wait_until_done() # for any error
+    names, total = cg.critical_path()
+    print(f'Critical path ({durations.format_eta(total)}): '
+          f'{" -> ".join(names)}')
 
+def start_chaos_workflow() -> None:
     # Get rid of any existing split-delay workflow, then apply the
     # chaos-mesh workflow for some (small) increased latency between
     # members. Note that this must be applied in the *Hazelcast* namespace,
@@ -1441,7 +1844,127 @@ def start_chaos_pods_svcs() -> None:
     k8s_crd_delete(chaos_splitdelay_crd, hz_namespace)
     kube_crd_apply(chaos_baselatency_crd, hz_namespace)
 
-def svcStop(onlyEmptyNodes: bool = False) -> None:
+#
+# Hibernation. We scale the worker nodes down to nothing, leaving the control
+# plane, bastion, DNS and network in place, so that resuming only needs to
+# wait for nodes to boot. Each cloud needs its own way of doing this:
+#
+#   GKE: the node pool can go to zero, so we just set NodeCount to zero and
+#        apply.
+#   EKS: the eks module ignores changes to the node group's desired size once
+#        it's created, so we scale the node groups directly.
+#   AKS: the default (system) node pool can't go below one node, so we stop
+#        the whole cluster instead, which also stops paying for it.
+#
+
+def hibernating() -> bool:
+    return os.path.exists(os.path.join(tfdir, hibernatingbf))
+
+def scale_eks_nodegroups(nodes: int) -> None:
+    ngs = runCollect(f"aws eks list-nodegroups --cluster-name {clustname} "
+                     "--query nodegroups --output text".split()).split()
+    for ng in ngs:
+        runStdout(f"aws eks update-nodegroup-config --cluster-name {clustname} "
+                  f"--nodegroup-name {ng} --scaling-config minSize=0,"
+                  f"maxSize={nk8snodes},desiredSize={nodes}".split())
+
+def hibernate_cluster() -> None:
+    if hibernating():
+        sys.exit(f'{clustname} is already hibernating')
+    # Nothing will run without nodes, and load balancers cost money, so empty
+    # the cluster first
+    svcStop(onlyEmptyNodes=True)
+    out.announce(f'Scaling {clustname} down to zero nodes')
+    with Timer('hibernate cluster'):
+        if target == "aws":
+            scale_eks_nodegroups(0)
+        elif target == "az":
+            runStdout(f"az aks stop --resource-group {resourcegrp} "
+                      f"--name {clustname}".split())
+        else:
+            terraform_start(nodes=0)
+    with open(os.path.join(tfdir, hibernatingbf), 'w'):
+        pass
+
+# Scale the nodes back up, without waiting for them to be ready
+def wake_nodes() -> None:
+    out.announce(f'Scaling {clustname} back up to {nk8snodes} nodes')
+    if target == "aws":
+        scale_eks_nodegroups(nk8snodes)
+    elif target == "az":
+        runStdout(f"az aks start --resource-group {resourcegrp} "
+                  f"--name {clustname}".split())
+    else:
+        terraform_start()
+    os.remove(os.path.join(tfdir, hibernatingbf))
+
+def resume_cluster() -> None:
+    if not hibernating():
+        sys.exit(f'{clustname} is not hibernating')
+    with Timer('resume cluster'):
+        wake_nodes()
+        env = get_output_vars()
+        with setup_k8s_api_tunnel(env['bastion_address'],
+                                  env['k8s_api_server']), ready.watching():
+            wait_until_k8s_is_ready()
+
+# Delete everything we put in the cluster, in reverse order to how it was
+# created. The Hazelcast and chaos-mesh namespaces go at the same time. The
+# chaos-mesh workflow CRDs live in the Hazelcast namespace, not the chaos-mesh
+# namespace, but their finalizers need the chaos-mesh controller, so they go
+# before its namespace does.
+def k8s_teardown() -> None:
+    def delete_hz_crds():
+        for crd in hz_crds:
+            k8s_crd_delete_templated(crd, hz_namespace)
+
+    def delete_chaos_crds():
+        for crd in chaos_crds:
+            k8s_crd_delete(crd, hz_namespace)
+
+    cg = CommandGroup()
+    cg.add_command(delete_hz_crds, 5, 'hz-crds-delete')
+    cg.add_command(lambda: k8s_teardown_namespace(hz_namespace), 20,
+                   'hz-teardown', after=['hz-crds-delete'])
+    cg.add_command(delete_chaos_crds, 5, 'chaos-crds-delete')
+    cg.add_command(lambda: k8s_teardown_namespace(chaos_namespace),
+                   20, 'chaos-teardown', after=['chaos-crds-delete'])
+
+    with Timer('teardown of K8S resources'):
+        cg.run_commands()
+        cg.wait_until_done()
+        runStdout(f"{kube} config set-context --namespace=default "
+                  "--current".split())
+
+def waitUntilNamespacesGone(namespaces: list[str]) -> float:
+    invalidateCache('namespaces') # we're here to see it change
+    existing = set(helmGetNamespaces())
+    gone = sum(1 for n in namespaces if n not in existing)
+    return safeDivide(gone, len(namespaces))
+
+def wait_for_namespaces_deleted(namespaces: list[str]) -> None:
+    out.announce(f'Waiting for namespaces {", ".join(namespaces)} to go')
+    out.spinWait(lambda: waitUntilNamespacesGone(namespaces),
+                 'namespaces deleted')
+
+# Terraform can't destroy the network while LBs are still using it. Returns
+# whether they all went in time.
+def wait_for_lbs_deleted(namespaces: list[str], before: int) -> bool:
+    deadline = time.time() + lbdeletetimeout
+    try:
+        out.spinWait(lambda: waitUntilLBServicesGone(namespaces, before,
+                                                     deadline),
+                     'load balancers deleted')
+    except TimeoutError as e:
+        print(f"# WARN {e} after service delete!")
+        print("# WARN This may cause dependency problems later!")
+        return False
+    print("No load balancers running after service delete.")
+    return True
+
+# With fast, delete only what would stop terraform destroying the cluster: the
+# LBs and their DNS records. Everything else goes with the cluster.
+def svcStop(onlyEmptyNodes: bool = False, fast: bool = False) -> None:
     # Re-establish the tunnel with the bastion to allow our commands to flow
     # through to the K8S cluster.
     out.announce("Re-establishing bastion tunnel")
@@ -1452,10 +1975,13 @@ def svcStop(onlyEmptyNodes: bool = False) -> None:
         zone_id = env['zone_id']
         bastion_ip = env['bastion_address']
         k8s_server_name = env['k8s_api_server']
+        kubeapply.configure(os.path.join(tfdir, appliedbf), k8s_server_name)
 
         # We need the bastion tunnel up in order to fetch the LBs
-        with setup_k8s_api_tunnel(bastion_ip, k8s_server_name):
-            wait_until_k8s_is_ready()
+        with setup_k8s_api_tunnel(bastion_ip, k8s_server_name), \
+                ready.watching():
+            # A hibernating cluster has no nodes to wait for
+            wait_until_k8s_is_ready(apiServerOnly=fast or hibernating())
 
             # NOTE: DNS *must* be removed since Terraform will complain about any
             # records it didn't create at the time the zone is destroyed.
@@ -1465,36 +1991,23 @@ def svcStop(onlyEmptyNodes: bool = False) -> None:
             except CalledProcessError:
                 print('Unable to delete DNS record sets (do they exist?)')
 
-            # tunnel established. Now delete things in reverse order to how
-            # they were created.
-
-            with Timer('teardown of K8S resources'):
-                for crd in hz_crds:
-                    k8s_crd_delete_templated(crd, hz_namespace, env)
-
-                helm_uninstall_releases_and_kill_pods(hz_namespace)
-
-                # Make sure to get rid of all services, in case they weren't
-                # already removed. We need to make sure we don't leak LBs.
-                lbs_were_cleaned = (lbs_were_cleaned and
-                                    delete_all_services(hz_namespace))
-
-                k8s_secrets_delete(hz_namespace)
-                k8s_pvc_delete(hz_namespace)
-                k8s_delete_namespace(hz_namespace)
-
-            with Timer('teardown of chaos-mesh K8S resources'):
-                # Delete all the CRDs applied. Note that the chaos-mesh
-                # workflow is installed in the Hazelcast namespace, not the
-                # chaos-mesh namespace.
-                for crd in chaos_crds:
-                    k8s_crd_delete(crd, hz_namespace)
-                helm_uninstall_releases_and_kill_pods(chaos_namespace)
-                lbs_were_cleaned = (lbs_were_cleaned and
-                                    delete_all_services(chaos_namespace))
-                k8s_secrets_delete(chaos_namespace)
-                k8s_pvc_delete(chaos_namespace)
-                k8s_delete_namespace(chaos_namespace)
+            teardown_nss = [hz_namespace, chaos_namespace]
+            lbs_before = sum(len(lb_service_names(n)) for n in teardown_nss)
+
+            if fast:
+                with Timer('deletion of load balancers'):
+                    for n in teardown_nss:
+                        delete_lb_services(n)
+            else:
+                k8s_teardown()
+
+            lbs_were_cleaned = wait_for_lbs_deleted(teardown_nss, lbs_before)
+
+            # Namespaces are deleted without waiting, which is fine when the
+            # cluster is going too. One we keep must be rid of them before
+            # anything can be created in namespaces of the same names.
+            if onlyEmptyNodes:
+                wait_for_namespaces_deleted(teardown_nss)
 
     except MissingTerraformOutput:
         out.announce('Terraform objects partly or fully destroyed')
@@ -1511,6 +2024,10 @@ def svcStop(onlyEmptyNodes: bool = False) -> None:
     out.announce(f"Ensuring cluster {clustname} is deleted")
     with Timer('stopping cluster'):
         runStdout(f"{tf} destroy -auto-approve".split())
+        tfcache.forget(tfdir)
+        for bf in (zonechoicebf, hibernatingbf, appliedbf):
+            if os.path.exists(f := os.path.join(tfdir, bf)):
+                os.remove(f)
 
 def getCloudSummary() -> List[str]:
     if target == "aws":
@@ -1696,15 +2213,23 @@ def cleanOldTunnels() -> None:
     # Check to see if anything looks suspiciously like an old ssh tunnel, and
     # see if the user is happy to kill them.
     out.announce('Looking for old tunnels to clean')
-    srchexp = f'ssh -N -L.+:.+:.+ {bastionuser}@'
+    # Only ssh connections left behind by runs that have gone; those still
+    # running may belong to racing zones or pool clusters. Older bigbangs ran
+    # an ssh per tunnel, so look for those on our ports too.
+    ports = "|".join(str(svcs.get_lcl_port(n))
+                     for n in svcs.get_all_svc_names())
+    srchexp = f'ssh -N -L(?:{ports}):.+:.+ {bastionuser}@'
     r = re.compile(srchexp)
     def get_tunnel_procs():
         nonlocal r
         tunnels = []
         for proc in psutil.process_iter(attrs=['pid', 'cmdline']):
-            if not proc.info['cmdline']:
+            if not (cmdline := proc.info['cmdline']):
                 continue
-            if r.match(" ".join(proc.info['cmdline'])):
+            if (owner := sshmux.owner(cmdline)) is not None:
+                if not psutil.pid_exists(owner):
+                    tunnels.append(proc)
+            elif r.match(" ".join(cmdline)):
                 tunnels.append(proc)
         return tunnels
 
@@ -1736,7 +2261,7 @@ def spinWaitCGTest():
                 time.sleep(float(w))
             return sleep_x
         cg.add_command(make_cb(w), w)
-    cg.run_commands()
+    cg.run_commands(max_workers=len(waits))
     out.spinWait(cg.ratio_done)
     cg.wait_until_done()
 
@@ -1780,9 +2305,7 @@ def check_creds() -> None:
             sys.exit("Have you run gcloud init?")
 
 def get_hz_cluster_podnames(ss_selector: str) -> list[str]:
-    return runCollect([kube, '-n', hz_namespace, 'get', 'pods',
-                       f'-l{ss_selector}',
-                       '-ojsonpath={.items[*].metadata.name}']).split()
+    return ready.pod_names(hz_namespace, ss_selector)
 
 def log_hz_cluster_member(ss_selector: str, podname: str) -> PodLog:
     selectors: list[str] = [ss_selector]
@@ -1849,10 +2372,8 @@ stage_can_retry = {
 test_stages = ['HELLO', 'MADDR', 'WLOAD', 'CHSTR', 'WCSTR', 'CHSTP', 'WTRES', 'ACKTR']
 
 def get_dev0_ip() -> str:
-    return runCollect([kube, 'get', 'pods',
-                       '-o=jsonpath={.items[?(@.metadata.name=="' +
-                       srvnm_cluster + "-0" +
-                       '")].status.podIP}'])
+    pod = kubeapi.get_item('pods', srvnm_cluster + "-0", hz_namespace)
+    return pod.get('status', {}).get('podIP', '') if pod else ''
 
 def bbclient_communicate(stages: list[str], dev0_ip: str) -> str:
     return_val: str = ""
@@ -1890,6 +2411,300 @@ def bbclient_communicate(stages: list[str], dev0_ip: str) -> str:
 
     return return_val
 
+def race_ready_file(zone: str) -> str:
+    return os.path.join(zone_tfdir(zone), 'ready')
+
+def race_verdict_file() -> str:
+    return os.path.join(bbio.where(target), 'zones', 'verdict')
+
+# The zone which won the race; empty if none did, or None if there's no
+# verdict yet
+def race_verdict() -> Optional[str]:
+    try:
+        with open(race_verdict_file()) as fh:
+            return fh.read().strip()
+    except FileNotFoundError:
+        return None
+
+# Start up a cluster in each of the first ns.race preferred zones, each in a
+# bigbang process of its own (see race_slot), and wait for the first to
+# become ready. That zone's state becomes ours, and we carry on with the rest
+# of the start-up in it; the others destroy themselves in the background.
+def race_zones() -> None:
+    zones = myvars[prefzonelabel][target][:ns.race]
+    state = tfcache.read_json(os.path.join(tfdir, tfcache.statef))
+    if state and state.get('resources'):
+        sys.exit(f'There is already a cluster in {zone}. Stop it before racing '
+                 'for another.')
+    if busy := [z for z in zones if os.path.exists(zone_tfdir(z))]:
+        sys.exit(f'{", ".join(busy)} still being cleaned up after a previous '
+                 f'race. Try again once {os.path.dirname(zone_tfdir(zone))} '
+                 'is empty.')
+    if os.path.exists(race_verdict_file()):
+        os.remove(race_verdict_file())
+
+    out.announce(f'Racing to start a cluster in {", ".join(zones)}')
+    racers: dict[str, subprocess.Popen] = {}
+    for slot, z in enumerate(zones):
+        logf = tmp_filename(f'race_{z}', 'log')
+        # Racers each get a kubeconfig of their own, as they'd otherwise
+        # fight over the current context
+        env = os.environ | {'KUBECONFIG': tmp_filename(f'race_{z}',
+                                                       'kubeconfig')}
+        args = [sys.executable, os.path.abspath(__file__), '-g', target,
+                '-z', z, '--race-slot', str(slot), 'start']
+        # Racers get a session of their own, so that the losers carry on
+        # cleaning up after we've moved on
+        with open(logf, 'w') as fh:
+            racers[z] = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                                         stdout=fh, stderr=subprocess.STDOUT,
+                                         env=env, start_new_session=True)
+        print(f'{z}: PID {racers[z].pid}, logging to {logf}')
+
+    winner = ""
+    failed: set[str] = set()
+    try:
+        while not winner:
+            for z, r in racers.items():
+                if r.poll() not in (None, 0) and z not in failed:
+                    failed.add(z)
+                    print(f'{z} failed to come up')
+            if done := [z for z in zones if os.path.exists(race_ready_file(z))]:
+                winner = done[0]
+            elif len(failed) == len(zones):
+                break
+            else:
+                time.sleep(racepoll)
+    finally:
+        # An empty verdict, if we failed or were interrupted, tells every
+        # racer to clean up
+        with open(race_verdict_file(), 'w') as fh:
+            fh.write(winner)
+
+    if not winner:
+        sys.exit(f'No cluster came up in any of {", ".join(zones)}')
+    out.announce(f'{winner} won the race; destroying the other clusters in '
+                 'the background')
+    if racers[winner].wait() != 0:
+        sys.exit(f'{winner} failed after winning the race')
+    adopt_zone(winner)
+
+    # Start over in the winning zone, now that its cluster is up
+    args = [sys.executable, os.path.abspath(__file__), '-g', target,
+            '-z', winner, '-c']
+    if ns.test:
+        args += ['-t', str(ns.test)]
+    os.execv(sys.executable, args + ['start'])
+
+# Take over the state of a racing zone, and make it the zone we use from now
+# on unless told otherwise
+def adopt_zone(winner: str) -> None:
+    zdir = zone_tfdir(winner)
+    varsroot = os.path.splitext(tfvars)[0]
+    removeOldVersions(os.path.join(tfdir, f'{varsroot}_*.tf'))
+    varsfile = ""
+    for f in glob.glob(os.path.join(zdir, f'{varsroot}_*.tf')):
+        shutil.copy(f, tfdir)
+        varsfile = os.path.join(tfdir, os.path.basename(f))
+    assert varsfile, f'No {tfvars} in {zdir}'
+    for f in (tfcache.lockf, tfcache.statef):
+        shutil.copy(os.path.join(zdir, f), tfdir)
+    if tfcache.needs_init(tfdir, varsfile):
+        runStdout(f"{tf} init -input=false".split())
+        tfcache.record_init(tfdir, varsfile)
+    # Nothing has changed since the winner applied its configuration, so
+    # there's nothing to apply here, and its outputs are still good
+    tfcache.record_apply(tfdir)
+    if outputs := tfcache.cached_outputs(zdir):
+        tfcache.cache_outputs(tfdir, tfcache.state_version(tfdir), outputs)
+    shutil.rmtree(zdir)
+    with open(os.path.join(tfdir, zonechoicebf), 'w') as fh:
+        fh.write(winner)
+
+# Bring up a cluster, and wait until it's ready for us to start on. If
+# keep_going returns False, we stop once the infrastructure's in place.
+def bring_up_cluster(keep_going: Callable[[], bool] = lambda: True) -> None:
+    terraform_start()
+    if not keep_going():
+        return
+    env = get_output_vars()
+    with setup_k8s_api_tunnel(env['bastion_address'], env['k8s_api_server']), \
+            ready.watching():
+        wait_until_k8s_is_ready()
+
+# Destroy a cluster we brought up in a working directory of its own, and the
+# directory with it
+def tear_down_work_dir() -> None:
+    if tfcache.state_version(tfdir) is not None:
+        out.announce(f'Destroying the cluster in {tfdir}')
+        runStdout(f"{tf} destroy -auto-approve -input=false".split())
+    shutil.rmtree(tfdir)
+
+# Run by each racer: bring up a cluster and wait until it's ready, then wait
+# to hear whether we won. Losers destroy whatever they got as far as creating,
+# as do racers which fail. Racers which hear they've lost while they're still
+# provisioning give up once the apply is done. If the bigbang running the race
+# goes without giving a verdict (killed outright, say), we've lost: nobody
+# else is going to use our cluster.
+def race_slot() -> None:
+    parent = os.getppid()
+    def verdict() -> Optional[str]:
+        if (v := race_verdict()) is None and os.getppid() != parent:
+            print('The race was abandoned; cleaning up')
+            return ""
+        return v
+
+    won = False
+    try:
+        if verdict() is None:
+            bring_up_cluster(lambda: verdict() is None)
+            with open(race_ready_file(zone), 'w'):
+                pass
+        while (v := verdict()) is None:
+            time.sleep(racepoll)
+        won = v == zone
+    finally:
+        if not won:
+            tear_down_work_dir()
+
+#
+# The warm pool. Each slot is a cluster of its own, with a working directory
+# under <target>/pool holding its Terraform state, its kubeconfig and these
+# markers:
+#
+#   ready:  the cluster is up, and ready to lease
+#   leased: someone is using it
+#
+# A slot whose directory has neither is still being provisioned, by a bigbang
+# process of its own running in the background (see provision_slot). We keep
+# poolsize clusters that aren't leased, building more as they're leased out,
+# and destroying those returned when there are enough.
+#
+
+def pool_marker(slot: int, marker: str) -> str:
+    return os.path.join(pool_tfdir(target, slot), marker)
+
+def pool_slots() -> list[int]:
+    pooldir = os.path.join(bbio.where(target), 'pool')
+    if not os.path.isdir(pooldir):
+        return []
+    return sorted(int(d) for d in os.listdir(pooldir) if d.isdigit())
+
+def leased_slots() -> list[int]:
+    return [s for s in pool_slots()
+            if os.path.exists(pool_marker(s, 'leased'))]
+
+# Held while counting the clusters in the pool and acting on the count, as
+# several leases and returns may be doing that at once
+@contextmanager
+def pool_locked():
+    pooldir = os.path.join(bbio.where(target), 'pool')
+    os.makedirs(pooldir, exist_ok=True)
+    with open(os.path.join(pooldir, '.lock'), 'w') as lockfh:
+        fcntl.flock(lockfh, fcntl.LOCK_EX)
+        yield
+
+# Start building clusters in the background until there are enough that
+# aren't leased. We claim each slot by creating its directory, which only one
+# of us can do.
+def fill_pool() -> None:
+    with pool_locked():
+        fill_pool_locked()
+
+def fill_pool_locked() -> None:
+    slots = pool_slots()
+    navail = len(slots) - len(leased_slots())
+    slot = 0
+    while navail < poolsize:
+        while slot in slots:
+            slot += 1
+        try:
+            os.mkdir(pool_tfdir(target, slot))
+        except FileExistsError:
+            slots.append(slot) # taken since we looked
+            continue
+        logf = tmp_filename(f'pool_{slot}', 'log')
+        args = [sys.executable, os.path.abspath(__file__), '-g', target,
+                '-s', str(slot), '--provision-only', 'start']
+        with open(logf, 'w') as fh:
+            subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=fh,
+                             stderr=subprocess.STDOUT, start_new_session=True)
+        print(f'Building a cluster for pool slot {slot}, logging to {logf}')
+        slots.append(slot)
+        navail += 1
+
+# Run in the background for each slot we add to the pool. If we fail, clean
+# up, so that the next fill_pool tries again.
+def provision_slot() -> None:
+    with open(os.path.join(tfdir, zonechoicebf), 'w') as fh:
+        fh.write(zone)
+    try:
+        bring_up_cluster()
+    except BaseException:
+        tear_down_work_dir()
+        raise
+    with open(pool_marker(ns.slot, 'ready'), 'w'):
+        pass
+
+# Lease a ready cluster from the pool, waiting for one if need be, and start
+# on it
+def pool_lease() -> None:
+    fill_pool()
+    out.announce('Waiting for a cluster in the pool to be ready')
+    slot = None
+    while slot is None:
+        for s in pool_slots():
+            if os.path.exists(pool_marker(s, 'ready')):
+                try:
+                    # Exclusive create, in case someone else is leasing too
+                    os.close(os.open(pool_marker(s, 'leased'),
+                                     os.O_CREAT | os.O_EXCL))
+                except FileExistsError:
+                    continue
+                slot = s
+                break
+        else:
+            if not pool_slots():
+                sys.exit('Every cluster in the pool failed to build; see the '
+                         'logs in /tmp')
+            time.sleep(racepoll)
+    out.announce(f'Leased the cluster in pool slot {slot}')
+    fill_pool() # replace the one we just took
+
+    args = [sys.executable, os.path.abspath(__file__), '-g', target,
+            '-s', str(slot), '-c']
+    if ns.test:
+        args += ['-t', str(ns.test)]
+    os.execv(sys.executable, args + ['start'])
+
+# Empty a leased cluster, and put it back in the pool
+def pool_return() -> None:
+    if ns.slot is None:
+        leased = leased_slots()
+        if len(leased) != 1:
+            sys.exit(f'Say which slot to return with --slot; leased slots are '
+                     f'{leased}')
+        os.execv(sys.executable, [sys.executable, os.path.abspath(__file__),
+                                  '-g', target, '-s', str(leased[0]),
+                                  'return'])
+    if not os.path.exists(pool_marker(ns.slot, 'leased')):
+        sys.exit(f'The cluster in pool slot {ns.slot} is not leased')
+    svcStop(onlyEmptyNodes=True)
+    # Leases top the pool up as they go, so if there are enough clusters
+    # waiting to be leased already, this one is surplus. It stays leased while
+    # it's destroyed, so that nobody else takes it.
+    with pool_locked():
+        surplus = len(pool_slots()) - len(leased_slots()) >= poolsize
+        if not surplus:
+            os.remove(pool_marker(ns.slot, 'leased'))
+    if surplus:
+        out.announce(f'The pool is full; destroying the cluster in pool slot '
+                     f'{ns.slot}')
+        svcStop()
+        shutil.rmtree(tfdir) # that's the end of this pool slot
+        return
+    out.announce(f'Returned the cluster in pool slot {ns.slot} to the pool')
+
 def main() -> None:
     if ns.progmeter_test:
         spinWaitCGTest()
@@ -1906,21 +2721,55 @@ def main() -> None:
     check_creds()
     checkRSAKey()
     checkEtcHosts()
-    cleanOldTunnels()
+    if ns.race_slot is None: # other racers' tunnels aren't old
+        cleanOldTunnels()
     if target == "gcp":
         out.announce(f'GCP project / account = {gcpproject} / {gcpaccount}')
     print(f"Your CIDR is {mySubnetCidr}")
 
     cloud_summary = getCloudSummary()
 
-    assert ns.command in ('start', 'stop') # already enforced above
+    # enforced above
+    assert ns.command in ('start', 'stop', 'lease', 'return', 'hibernate',
+                          'resume')
+
+    ###############
+    # HIBERNATION #
+    ###############
+
+    if ns.command == 'hibernate':
+        hibernate_cluster()
+        out.announceLoud(cloud_summary + ['Cluster is hibernating'])
+        return
+    if ns.command == 'resume':
+        resume_cluster()
+        out.announceLoud(cloud_summary + ['Cluster has resumed'])
+        return
+
+    ########
+    # POOL #
+    ########
+
+    if ns.command == 'lease':
+        pool_lease() # doesn't return; carries on as start in the leased slot
+    if ns.command == 'return':
+        pool_return()
+        return
 
     #################
     # STOP SERVICES #
     #################
 
     if ns.command == 'stop':
-        svcStop(ns.empty_nodes)
+        # A stopped AKS cluster has no API server for us to empty it through,
+        # and a cluster we're keeping needs its nodes back anyway. Otherwise
+        # a hibernating cluster is torn down without waiting for nodes (see
+        # svcStop).
+        if hibernating() and (target == "az" or ns.empty_nodes):
+            wake_nodes()
+        svcStop(ns.empty_nodes, ns.fast)
+        if ns.slot is not None and not ns.empty_nodes:
+            shutil.rmtree(tfdir) # that's the end of this pool slot
         setup_summary = cloud_summary + ['Service is stopped']
         out.announceLoud(setup_summary)
         return
@@ -1929,9 +2778,22 @@ def main() -> None:
     # START SERVICES #
     ##################
 
+    if ns.race_slot is not None:
+        race_slot()
+        return
+    if ns.provision_only:
+        provision_slot()
+        return
+    if ns.race:
+        race_zones()
+
     if ns.test:
         test_output_fn = tmp_filename('test_output', 'out', random=True)
 
+    # A hibernating cluster only needs its nodes back
+    if hibernating():
+        wake_nodes()
+
     # First start up the K8S cluster and other cloud resources using Terraform
     if not ns.skip_cluster_start:
         with Timer('set up infrastructure in Terraform'):
@@ -1942,19 +2804,28 @@ def main() -> None:
         env = get_output_vars()
         bastion_addr = env['bastion_address']
         k8s_api_addr = env['k8s_api_server']
+        kubeapply.configure(os.path.join(tfdir, appliedbf), k8s_api_addr)
     except MissingTerraformOutput:
         sys.exit('skip_cluster_start requested but Terraform is not set up')
 
     # Open the SSH tunnel to the K8S API Server
-    with setup_k8s_api_tunnel(bastion_addr, k8s_api_addr):
+    with setup_k8s_api_tunnel(bastion_addr, k8s_api_addr), ready.watching():
         wait_until_k8s_is_ready()
 
-        with Timer(f'set up {hz_namespace} namespace objects'):
-            start_hz_pods_svcs(env, secrets)
+        with Timer('set up namespace objects'):
+            start_pods_svcs(env, secrets)
+
+        # Hazelcast and chaos-mesh come up independently, so wait on all of
+        # their pods and services together. There are no chaos-mesh services
+        # to wait for.
+        goals = hazelcast_pod_goals() + hazelcast_svc_goals()
+        if ns.test:
+            goals += chaosmesh_pod_goals()
+        with Timer('wait for pods and services'):
+            wait_for_goals(goals)
 
         if ns.test:
-            with Timer(f'set up {chaos_namespace} namespace objects'):
-                start_chaos_pods_svcs()
+            start_chaos_workflow()
 
         # Create--but do not start--port-forward tuns for k8s svc LBs, meaning
         # any Hazelcast service LBs plus any client service LBs
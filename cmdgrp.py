@@ -1,35 +1,114 @@
 # bigbang-specific
+import durations
 
 # other
+import time
 import threading
-from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional
 
+# How many commands from one group may run at once, unless the caller says
+# otherwise
+default_max_workers = 4
+
+# Threads shared by every CommandGroup, created on first use
+pool_size = 16
+pool: Optional[ThreadPoolExecutor] = None
+pool_lock = threading.Lock()
+
+# How often wait_until_done wakes up to check for commands past their deadline
+deadline_poll = 0.5
+
+def get_pool() -> ThreadPoolExecutor:
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=pool_size,
+                                      thread_name_prefix='cmdgrp')
+        return pool
+
+class Cancelled(Exception):
+    pass
+
+class Command:
+    def __init__(self, name: str, f: Callable[[], None], work: int,
+                 after: list[str], timeout: Optional[float]):
+        self.name = name
+        self.f = f
+        self.work = work
+        self.after = after # names of commands which must finish first
+        self.timeout = timeout
+        self.deadline = float('inf')
+        self.state = 'queued' # -> running -> done | failed | cancelled
+        self.error: Optional[BaseException] = None
+        self.elapsed = 0.0
+        self.cancel_event = threading.Event()
+
+    def finished(self) -> bool:
+        return self.state in ('done', 'failed', 'cancelled')
+
+# The command running on this thread, if any, so that long-running commands
+# can check whether they've been asked to stop
+current = threading.local()
+
+# Commands are cancelled cooperatively: we can't stop a thread, so this is
+# called before a command starts each external process, and every so often
+# while it waits on one (see run.communicate), which is then killed. A command
+# with long steps of its own should call it between them too. Raises
+# Cancelled if the command has been cancelled or run past its deadline.
+def check_cancelled() -> None:
+    cmd: Optional[Command] = getattr(current, 'cmd', None)
+    if cmd and cmd.cancel_event.is_set():
+        raise Cancelled(f'{cmd.name} cancelled')
+
+# A group of commands, each of which may depend on others having finished
+# first. Commands run on a pool of threads shared between groups, and are
+# started as soon as their prerequisites are done, with no more than
+# max_workers from the group running at once. If a command fails, everything
+# that depends on it (directly or not) is cancelled; everything else carries
+# on. A command given a timeout fails once it runs past it, and the whole
+# group can be cancelled; either way, running commands stop at their next
+# call to check_cancelled, which happens at least every run.cancel_poll
+# seconds while they're running an external command.
+#
+# Progress is measured in units of work: the number of seconds a named command
+# has usually taken on this profile if we've seen it before, or otherwise the
+# caller's guess. Failed or cancelled commands count as finished so that
+# progress still reaches 100%.
 class CommandGroup:
     def __init__(self):
         self.cv = threading.Condition() # producer-consumer lock
         self.work_to_do: int = 0
         self.work_done: int = 0
-        self.cmds_queued: list[Callable[[], None]] = []
-        self.cmds_running: list[Callable[[], None]] = []
+        self.cmds_queued: list[Command] = []
+        self.cmds_running: list[Command] = []
+        self.max_workers = default_max_workers
+        self.active = 0 # commands on a worker right now
+        self.first_error: Optional[BaseException] = None
+        self.sequential = False
 
     def check_not_running(self) -> None:
         assert (n := len(self.cmds_running)) < 1, \
                 f'{n} threads already running'
 
+    # Prerequisites must have been added already, which guarantees there are
+    # no cycles, and that the order of addition is a valid order to run in
     def add_command(self, f: Callable[[], None],
-                    new_work: int) -> None:
-        def make_cb_work_done(f: Callable[[], None],
-                              new_work: int) -> Callable[[], None]:
-            def cb_work_done():
-                f()
-                with self.cv:
-                    self.work_done += new_work
-                    self.cv.notify_all()
-            return cb_work_done
-
+                    new_work: int,
+                    name: str = "",
+                    after: Iterable[str] = (),
+                    timeout: Optional[float] = None) -> None:
         with self.cv:
             self.check_not_running()
-            self.cmds_queued.append(make_cb_work_done(f, new_work))
+            names = {c.name for c in self.cmds_queued}
+            name = name or f'cmd{len(self.cmds_queued)}'
+            assert name not in names, f'Duplicate command {name}'
+            after = list(after)
+            for prereq in after:
+                assert prereq in names, f'{name}: unknown prerequisite {prereq}'
+            if (est := durations.estimate(name)) is not None:
+                new_work = max(1, round(est))
+            self.cmds_queued.append(Command(name, f, new_work, after, timeout))
             self.work_to_do += new_work
 
     def check_running(self) -> None:
@@ -42,31 +121,167 @@ class CommandGroup:
             self.cmds_queued = []
             self.check_running()
 
-    def run_commands(self) -> None:
-        self.move_to_running_mode()
+    def get(self, name: str) -> Command:
+        return next(c for c in self.cmds_running if c.name == name)
+
+    # Must be called with lock held
+    def finish(self, cmd: Command, state: str,
+               error: Optional[BaseException] = None) -> None:
+        if cmd.state == 'running':
+            self.active -= 1
+        cmd.state = state
+        cmd.error = error
+        if error and not self.first_error:
+            self.first_error = error
+        self.work_done += cmd.work
+        self.cv.notify_all()
+
+    # Must be called with lock held
+    def start(self, cmd: Command) -> None:
+        cmd.state = 'running'
+        self.active += 1
+
+    # Must be called with lock held. Cancel whatever can no longer run, and
+    # start whatever is ready to, up to our limit on workers. Commands are in
+    # dependency order, so a single pass catches chains of cancellations.
+    def dispatch(self) -> None:
+        for cmd in self.cmds_running:
+            if cmd.state != 'queued':
+                continue
+            prereqs = [self.get(p) for p in cmd.after]
+            if (cmd.cancel_event.is_set() or
+                any(p.state in ('failed', 'cancelled') for p in prereqs)):
+                self.finish(cmd, 'cancelled')
+            elif (all(p.state == 'done' for p in prereqs) and
+                  self.active < self.max_workers):
+                self.start(cmd)
+                get_pool().submit(self.run_one, cmd)
+
+    # Must be called with lock held. Fail any command which has run past its
+    # deadline, and ask it to stop. Its worker stays busy until it does, but
+    # it no longer counts against max_workers, nor holds up its group.
+    def expire(self) -> None:
+        now = time.time()
+        expired = False
         for cmd in self.cmds_running:
-            t = threading.Thread(target = cmd)
-            t.start()
+            if cmd.state == 'running' and now >= cmd.deadline:
+                cmd.cancel_event.set()
+                self.finish(cmd, 'failed', TimeoutError(
+                    f'{cmd.name} did not finish within {cmd.timeout}s'))
+                expired = True
+        if expired and not self.sequential:
+            self.dispatch()
+
+    def run_one(self, cmd: Command) -> None:
+        state = 'done'
+        error = None
+        start = time.time()
+        with self.cv:
+            # The deadline runs from when we get a worker, not from when we
+            # were queued for one
+            if cmd.timeout is not None:
+                cmd.deadline = start + cmd.timeout
+        current.cmd = cmd
+        try:
+            cmd.f()
+        except Cancelled:
+            state = 'cancelled'
+        except BaseException as e: # including sys.exit from a command
+            state = 'failed'
+            error = e
+        finally:
+            current.cmd = None
+        cmd.elapsed = time.time() - start
+        with self.cv:
+            if cmd.finished():
+                return # timed out already; nobody's waiting on us now
+            if state == 'done':
+                durations.observe(cmd.name, cmd.elapsed)
+            self.finish(cmd, state, error)
+            if not self.sequential:
+                self.dispatch()
+
+    def run_commands(self, max_workers: Optional[int] = None) -> None:
+        self.move_to_running_mode()
+        with self.cv:
+            if max_workers:
+                self.max_workers = max_workers
+            self.dispatch()
 
     def run_commands_seq(self) -> None:
         self.move_to_running_mode()
+        self.sequential = True
         for cmd in self.cmds_running:
-            cmd()
+            with self.cv:
+                self.dispatch_seq(cmd)
+            if cmd.state == 'running':
+                self.run_one(cmd)
+        self.raise_first_error()
+
+    # Must be called with lock held
+    def dispatch_seq(self, cmd: Command) -> None:
+        if (cmd.cancel_event.is_set() or
+            any(self.get(p).state != 'done' for p in cmd.after)):
+            self.finish(cmd, 'cancelled')
+        else:
+            self.start(cmd)
+
+    # Ask every command that hasn't finished to stop. Queued commands will
+    # never start; running ones stop when they next call check_cancelled.
+    def cancel(self) -> None:
+        with self.cv:
+            for cmd in self.cmds_running + self.cmds_queued:
+                cmd.cancel_event.set()
+            if self.cmds_running and not self.sequential:
+                self.dispatch()
 
     # Must be called with lock held--and this is only called by wait_for on the
     # condition variable, which always guarantees the lock is held
     def all_commands_done(self) -> bool:
         assert self.work_done <= self.work_to_do
-        return self.work_done == self.work_to_do
+        return all(c.finished() for c in self.cmds_running)
 
-    def wait_until_done(self) -> None:
+    def raise_first_error(self) -> None:
         with self.cv:
-            self.check_running()
-            self.cv.wait_for(self.all_commands_done)
+            error = self.first_error
+        if error:
+            raise error
+
+    # Returns once every command has finished, one way or another. If any
+    # failed, raises the exception from the first to fail. If we're
+    # interrupted while waiting, the remaining commands are cancelled.
+    def wait_until_done(self) -> None:
+        try:
+            with self.cv:
+                self.check_running()
+                while not self.all_commands_done():
+                    self.expire()
+                    self.cv.wait(deadline_poll)
+        except KeyboardInterrupt:
+            self.cancel()
+            raise
+        self.raise_first_error()
+
+    # The chain of commands which took longest from start to finish, going by
+    # how long each took this time, or is estimated to take if it didn't run.
+    # Returns the names along the chain and its total duration.
+    def critical_path(self) -> tuple[list[str], float]:
+        cmds = self.cmds_running or self.cmds_queued
+        # longest chain ending at each command; commands are in dependency
+        # order, so prerequisites are always seen first
+        chains: dict[str, tuple[list[str], float]] = {}
+        for cmd in cmds:
+            dur = cmd.elapsed if cmd.state == 'done' else \
+                    durations.estimate(cmd.name) or 0.0
+            names, longest = max((chains[p] for p in cmd.after),
+                                 key=lambda c: c[1], default=([], 0.0))
+            chains[cmd.name] = (names + [cmd.name], longest + dur)
+        return max(chains.values(), key=lambda c: c[1], default=([], 0.0))
 
     def ratio_done(self) -> float:
         with self.cv:
             self.check_running()
+            self.expire()
             assert self.work_done <= self.work_to_do, \
                     f"{self.work_done} should be <= {self.work_to_do}"
             # It's possible that no commands were processed, in which case
@@ -0,0 +1,130 @@
+import os
+import sys
+import json
+import math
+import time
+import atexit
+import tempfile
+import threading
+from typing import Any, Optional
+
+#
+# Per-session trace of every external command we run: when it started and
+# ended, its argv and return code, how much output it produced, and which of
+# our functions ran it. Records go to a JSON-lines file as they complete, and
+# a summary of where the time went is printed at exit.
+#
+# Other measurements taken during the session (such as tunnel round trips) go
+# to the same file as named samples, and their percentiles are written there
+# and printed at exit too.
+#
+
+tracefn = os.path.join(tempfile.gettempdir(),
+                       time.strftime('bigbang_trace_%Y%m%d_%H%M%S') +
+                       f'_{os.getpid()}.jsonl')
+summary_rows = 15 # commands shown in the summary at exit
+
+lock = threading.Lock()
+fh: Optional[Any] = None
+# command summary -> list of durations
+durations: dict[str, list[float]] = {}
+# sample name -> list of values
+samples: dict[str, list[float]] = {}
+
+# Frames from these files are plumbing; the caller is the first frame that
+# isn't one of them
+plumbing = {'run.py', 'cmdtrace.py', 'kubeapi.py', 'ready.py', 'contextlib.py',
+            'threading.py', 'subprocess.py',
+            # asyncio, for commands run through run.arun
+            'events.py', 'base_events.py', 'tasks.py', 'runners.py'}
+
+def caller() -> str:
+    f = sys._getframe(1)
+    while f:
+        fn = os.path.basename(f.f_code.co_filename)
+        if fn not in plumbing and not fn.startswith('<'):
+            return f'{fn[:-3]}.{f.f_code.co_name}'
+        f = f.f_back # type: ignore
+    return '?'
+
+# Group commands by tool and the first couple of words that follow it, so that
+# 'kubectl -n x get pods' and 'kubectl -n y get pods' count together
+def summarize(args) -> str:
+    # run imports us, so we can't import it until it's loaded
+    from run import parseCommand
+    words, _ = parseCommand(list(args))
+    return " ".join(words[:3]) if words else "?"
+
+# Must be called with lock held. The trace has whole command lines in it,
+# secrets and all, so it's for our eyes only.
+def write_locked(rec: dict) -> None:
+    global fh
+    if fh is None:
+        fh = open(os.open(tracefn, os.O_CREAT | os.O_APPEND | os.O_WRONLY,
+                          0o600), 'a')
+    fh.write(json.dumps(rec) + '\n')
+    fh.flush()
+
+def write(rec: dict) -> None:
+    with lock:
+        write_locked(rec)
+
+def record(args, start: float, end: float, rc: Optional[int],
+           nbytes: int = 0, cached: bool = False) -> None:
+    cmd = summarize(args)
+    write({'start': start,
+           'end': end,
+           'dur': round(end - start, 6),
+           'argv': list(args),
+           'rc': rc,
+           'bytes': nbytes,
+           'cached': cached,
+           'caller': caller()})
+    if not cached:
+        with lock:
+            durations.setdefault(cmd, []).append(end - start)
+
+def sample(name: str, value: float) -> None:
+    with lock:
+        write_locked({'time': time.time(), 'sample': name,
+                      'value': round(value, 6)})
+        samples.setdefault(name, []).append(value)
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+sample_pcts = (50, 95, 99)
+
+def print_summary() -> None:
+    global fh
+    with lock:
+        for name, values in samples.items():
+            write_locked({'summary': name, 'count': len(values)} |
+                         {f'p{pct}': round(percentile(values, pct), 6)
+                          for pct in sample_pcts})
+        rows = sorted(durations.items(), key=lambda kv: sum(kv[1]),
+                      reverse=True)[:summary_rows]
+        sampled = sorted(samples.items())
+        if fh:
+            fh.close()
+            fh = None
+    if rows:
+        w = max(len(cmd) for cmd, _ in rows)
+        print(f'Slowest commands this session (trace in {tracefn}):')
+        print(f'{"command".ljust(w)}  {"total":>8}  {"count":>5}  {"p95":>7}')
+        for cmd, durs in rows:
+            print(f'{cmd.ljust(w)}  {sum(durs):7.1f}s  {len(durs):5d}  '
+                  f'{percentile(durs, 95):6.2f}s')
+    if sampled:
+        w = max(len(name) for name, _ in sampled)
+        print(f'Measurements this session (trace in {tracefn}):')
+        print(f'{"sample".ljust(w)}  {"count":>5}' +
+              "".join(f'  {"p" + str(pct):>7}' for pct in sample_pcts))
+        for name, values in sampled:
+            print(f'{name.ljust(w)}  {len(values):5d}' +
+                  "".join(f'  {percentile(values, pct):7.3f}'
+                          for pct in sample_pcts))
+
+atexit.register(print_summary)
@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import fcntl
+import tempfile
+import statistics
+import threading
+from typing import Optional
+
+# local imports
+import bbio
+
+#
+# How long each named phase of a run has taken in the past: Timer sections,
+# readiness goals and CommandGroup steps. Observations are kept separately for
+# each profile (cloud target, instance type and node count), since a 10-node
+# GKE cluster comes up at a very different pace from a 4-node EKS one. We use
+# them to weight progress and to estimate time remaining.
+#
+
+historyf = bbio.where('durations.json')
+historylockf = historyf + '.lock' # held while updating historyf
+keep = 5 # observations kept per phase; we estimate from their median
+
+lock = threading.Lock()
+profile = "default"
+history: dict[str, dict[str, list[float]]] = {}
+loaded = False
+
+def configure(new_profile: str) -> None:
+    global profile
+    profile = new_profile
+
+def read() -> dict[str, dict[str, list[float]]]:
+    try:
+        with open(historyf) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+def load() -> None:
+    global history, loaded
+    if loaded:
+        return
+    loaded = True
+    history = read()
+
+def save() -> None:
+    fd, tmpf = tempfile.mkstemp(dir=os.path.dirname(historyf),
+                                prefix='durations.', suffix='.tmp')
+    try:
+        with open(fd, 'w') as fh:
+            json.dump(history, fh, indent=1, sort_keys=True)
+        os.replace(tmpf, historyf)
+    except BaseException:
+        os.remove(tmpf)
+        raise
+
+# Estimated duration of a phase in seconds, or None if we've never seen it
+def estimate(phase: str) -> Optional[float]:
+    if not phase:
+        return None
+    with lock:
+        load()
+        if obs := history.get(profile, {}).get(phase):
+            return statistics.median(obs)
+    return None
+
+# Must be called with lock held
+def add(phase: str, seconds: float) -> None:
+    obs = history.setdefault(profile, {}).setdefault(phase, [])
+    obs.append(round(seconds, 1))
+    del obs[:-keep]
+
+# Other bigbangs (zone racers, pool builders) may be observing at the same
+# time, so each observation goes into the history as it is on disk now, under
+# a lock, rather than our copy of it replacing theirs
+def observe(phase: str, seconds: float) -> None:
+    global history, loaded
+    if not phase:
+        return
+    with lock:
+        added = False
+        try:
+            with open(historylockf, 'w') as lockfh:
+                fcntl.flock(lockfh, fcntl.LOCK_EX)
+                history = read()
+                loaded = True
+                add(phase, seconds)
+                added = True
+                save()
+        except OSError:
+            pass # not worth failing a run over
+        if not added: # we can still use it ourselves
+            load()
+            add(phase, seconds)
+
+def format_eta(seconds: float) -> str:
+    return time.strftime("%Mm%Ss", time.gmtime(max(0.0, seconds)))
@@ -0,0 +1,357 @@
+import os
+import json
+import time
+import atexit
+import shutil
+import base64
+import socket
+import tempfile
+import threading
+import subprocess
+from subprocess import CalledProcessError
+from datetime import datetime
+from typing import Any, Callable, Iterator, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# local imports
+import run
+
+#
+# A small in-process client for the Kubernetes API server. We talk to the API
+# server through the same ssh tunnel kubectl uses (the kubeconfig has already
+# been pointed at it by updateKubeConfig), reusing the credentials from the
+# current kubeconfig context. Requests share a keep-alive connection pool, so
+# after the first one we pay neither a process start nor a TLS handshake.
+#
+# Reads and deletes should go through list_items / get_item / delete_item /
+# delete_items below, which fall back to kubectl if the API server can't be
+# reached directly.
+#
+
+# Where each kind of object we care about lives in the API. Namespaced kinds
+# have a {ns} placeholder which is either empty (all namespaces) or
+# 'namespaces/<namespace>/'.
+resource_paths = {
+        'nodes':       '/api/v1/nodes',
+        'namespaces':  '/api/v1/namespaces',
+        'pods':        '/api/v1/{ns}pods',
+        'services':    '/api/v1/{ns}services',
+        'secrets':     '/api/v1/{ns}secrets',
+        'persistentvolumeclaims': '/api/v1/{ns}persistentvolumeclaims',
+        'deployments': '/apis/apps/v1/{ns}deployments'
+        }
+
+# Server-side timeout for a single watch request. The API server closes the
+# stream after this, and the watcher simply resumes from the last
+# resourceVersion it saw.
+watch_timeout = 240
+
+# Connections kept open to the API server. Watches hold one each for as long
+# as they run, so leave plenty of room for ordinary requests.
+pool_size = 16
+
+# Objects per page when listing. Callers consume a page at a time, so this
+# bounds how much we hold in memory on a big cluster.
+page_size = 250
+
+# Ask the API server for metadata only, for when that's all we need
+metadata_only_accept = ('application/json;as=PartialObjectMetadataList;'
+                        'g=meta.k8s.io;v=v1,application/json')
+
+class KubeApiError(Exception):
+    pass
+
+# Key material from the kubeconfig goes in a directory only we can read, and
+# which goes away when we exit
+secretdir: Optional[str] = None
+secretdir_lock = threading.Lock()
+
+def remove_secretdir() -> None:
+    if secretdir:
+        shutil.rmtree(secretdir, ignore_errors=True)
+
+# Write base64-encoded kubeconfig data out to a file only the user can read
+def write_secret_file(data: str, ext: str) -> str:
+    global secretdir
+    with secretdir_lock:
+        if secretdir is None:
+            secretdir = tempfile.mkdtemp(prefix='bbkube_')
+            atexit.register(remove_secretdir)
+    fd, filename = tempfile.mkstemp(dir=secretdir, suffix=f'.{ext}')
+    with os.fdopen(fd, 'wb') as fh:
+        fh.write(base64.b64decode(data))
+    return filename
+
+class Credentials:
+    def __init__(self):
+        self.server = ""
+        self.token = ""
+        self.expiry = 0.0
+        self.exec_spec: Optional[dict] = None
+        self.cert: Optional[tuple[str, str]] = None
+        self.lock = threading.Lock() # shared by the watcher threads
+
+    # Read the current context out of the kubeconfig. This costs one kubectl
+    # process, but only happens once per client (and again whenever the token
+    # expires).
+    def load(self) -> None:
+        cfg = json.loads(run.runCollect("kubectl config view --minify --raw "
+                                        "-ojson".split()))
+        try:
+            self.server = cfg['clusters'][0]['cluster']['server']
+            user = cfg['users'][0]['user']
+        except (KeyError, IndexError) as e:
+            raise KubeApiError(f'No usable kubeconfig context: {e}')
+
+        if token := user.get('token'):
+            self.token = token
+            self.expiry = float('inf')
+        elif ((certdata := user.get('client-certificate-data')) and
+              (keydata := user.get('client-key-data'))):
+            # AKS hands out client certificates, which requests wants as files
+            self.cert = (write_secret_file(certdata, 'crt'),
+                         write_secret_file(keydata, 'key'))
+        elif exec_spec := user.get('exec'):
+            # EKS, GKE and (with kubelogin) AKS all hand out short-lived
+            # tokens from a credential plugin
+            self.exec_spec = exec_spec
+            self.refresh()
+        else:
+            raise KubeApiError('Only token, client certificate and '
+                               'exec-plugin credentials are supported')
+
+    def refresh(self) -> None:
+        assert self.exec_spec is not None
+        env = os.environ.copy()
+        for e in self.exec_spec.get('env') or []:
+            env[e['name']] = e['value']
+        args = [self.exec_spec['command']] + (self.exec_spec.get('args') or [])
+        r = subprocess.run(args, capture_output=True, text=True, env=env,
+                           check=True)
+        status = json.loads(r.stdout)['status']
+        if not (token := status.get('token')):
+            raise KubeApiError(f'{args[0]} did not return a bearer token')
+        self.token = token
+        self.expiry = float('inf')
+        if exp := status.get('expirationTimestamp'):
+            if exp.endswith('Z'):
+                exp = exp[:-1] + "+00:00"
+            # Renew a minute early so we never present a stale token
+            self.expiry = datetime.fromisoformat(exp).timestamp() - 60
+
+    def headers(self) -> dict[str, str]:
+        if self.cert:
+            return {}
+        with self.lock:
+            if time.time() >= self.expiry:
+                self.refresh()
+            return {'Authorization': f'Bearer {self.token}'}
+
+class KubeApi:
+    # Pass in the credentials of an existing client to share them (and their
+    # token refreshes) rather than reading the kubeconfig again
+    def __init__(self, creds: Optional[Credentials] = None):
+        if not creds:
+            creds = Credentials()
+            creds.load()
+        self.creds = creds
+        self.session = requests.Session()
+        self.session.verify = False # kubeconfig skips TLS verify as well
+        self.session.cert = self.creds.cert
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+
+    def path(self, kind: str, namespace: str = "", name: str = "") -> str:
+        if kind not in resource_paths:
+            raise KubeApiError(f'Unknown resource kind {kind}')
+        nsp = f'namespaces/{namespace}/' if namespace else ''
+        p = resource_paths[kind].format(ns=nsp)
+        return f'{p}/{name}' if name else p
+
+    def request(self, path: str, params: Optional[dict] = None,
+                stream: bool = False,
+                timeout: Optional[float] = 30,
+                method: str = 'GET',
+                ok: tuple[int, ...] = (200,),
+                accept: str = "") -> requests.Response:
+        headers = self.creds.headers()
+        if accept:
+            headers['Accept'] = accept
+        r = self.session.request(method, self.creds.server + path,
+                                 params=params, headers=headers,
+                                 stream=stream, timeout=timeout)
+        if r.status_code not in ok:
+            raise KubeApiError(f'{method} {path} returned {r.status_code}')
+        return r
+
+    # Yield the list a page at a time. The last page carries the
+    # resourceVersion to watch from.
+    def list_pages(self, kind: str, namespace: str = "", selector: str = "",
+                   metadata_only: bool = False) -> Iterator[dict[str, Any]]:
+        params = {'limit': str(page_size)}
+        if selector:
+            params['labelSelector'] = selector
+        accept = metadata_only_accept if metadata_only else ""
+        while True:
+            page = self.request(self.path(kind, namespace), params=params,
+                                accept=accept).json()
+            yield page
+            if not (cont := page['metadata'].get('continue')):
+                return
+            params['continue'] = cont
+
+    def list(self, kind: str, namespace: str = "", selector: str = "",
+             metadata_only: bool = False) -> dict[str, Any]:
+        items: list[dict[str, Any]] = []
+        for page in self.list_pages(kind, namespace, selector, metadata_only):
+            items += page['items']
+        return {'metadata': page['metadata'], 'items': items}
+
+    # Returns None if there's no such object
+    def get(self, kind: str, name: str,
+            namespace: str = "") -> Optional[dict[str, Any]]:
+        r = self.request(self.path(kind, namespace, name), ok=(200, 404))
+        return r.json() if r.status_code == 200 else None
+
+    # Returns False if there was no such object to delete
+    def delete(self, kind: str, name: str, namespace: str = "",
+               grace_period: Optional[int] = None) -> bool:
+        params = ({'gracePeriodSeconds': str(grace_period)}
+                  if grace_period is not None else None)
+        r = self.request(self.path(kind, namespace, name), params=params,
+                         method='DELETE', ok=(200, 202, 404))
+        return r.status_code != 404
+
+    # Yield watch events for the given kind, starting after resource_version,
+    # until the API server closes the stream. opened is handed the response
+    # once the stream is open, so that it can be interrupted.
+    def watch(self, kind: str, resource_version: str,
+              opened: Optional[Callable[[requests.Response], None]] = None
+              ) -> Iterator[dict]:
+        params = {'watch': 'true',
+                  'resourceVersion': resource_version,
+                  'allowWatchBookmarks': 'true',
+                  'timeoutSeconds': str(watch_timeout)}
+        with self.request(self.path(kind), params=params, stream=True,
+                          timeout=watch_timeout + 30) as r:
+            if opened:
+                opened(r)
+            for line in r.iter_lines():
+                if line:
+                    yield json.loads(line)
+
+    def close(self) -> None:
+        self.session.close()
+
+# Cut off a streaming response that another thread is reading, which then gets
+# one of api_errors. Closing the response doesn't wake a thread blocked
+# reading it, but shutting down its socket does. We go under SSLSocket's
+# shutdown, which would pull the TLS state out from under the reader.
+def interrupt(r: requests.Response) -> None:
+    if (conn := r.raw.connection) and conn.sock:
+        try:
+            socket.socket.shutdown(conn.sock, socket.SHUT_RDWR)
+        except OSError:
+            pass # already closed
+
+# The client for this run, once the API server is reachable through the tunnel
+api: Optional[KubeApi] = None
+
+def connect() -> None:
+    global api
+    if api:
+        return
+    try:
+        api = KubeApi()
+    except (KubeApiError, CalledProcessError, ValueError) as e:
+        print(f'Unable to reach API server directly, using kubectl: {e}')
+
+def disconnect() -> None:
+    global api
+    if api:
+        api.close()
+        api = None
+
+api_errors = (requests.exceptions.RequestException, KubeApiError, ValueError)
+
+def kubectl_get(kind: str, namespace: str = "", name: str = "",
+                selector: str = "") -> list[str]:
+    args = ['kubectl', 'get', kind]
+    if name:
+        args.append(name)
+    if namespace:
+        args += ['-n', namespace]
+    elif not name:
+        args.append('--all-namespaces')
+    if selector:
+        args.append(f'-l{selector}')
+    return args + ['-ojson']
+
+# List objects of the given kind; across all namespaces if none is given. If
+# metadata_only is set, the objects carry nothing but their metadata, which
+# keeps the likes of secrets and their contents off the wire. Raises
+# CalledProcessError if the kubectl fallback fails. Results are cached by the
+# run module just as the equivalent kubectl command's would be.
+def list_items(kind: str, namespace: str = "", selector: str = "",
+               metadata_only: bool = False) -> list[dict[str, Any]]:
+    args = kubectl_get(kind, namespace, selector=selector)
+    if metadata_only:
+        # kubectl can't ask the server for metadata only, but at least only
+        # parse what we need, an object at a time
+        args[-1] = '-ojsonpath={range .items[*]}{.metadata}{"\\n"}{end}'
+    if (items := run.cachedResult(args)) is not None:
+        return items
+    items = None
+    if api:
+        try:
+            items = api.list(kind, namespace, selector, metadata_only)['items']
+        except api_errors:
+            pass
+    if items is None and metadata_only:
+        items = [{'metadata': json.loads(line)} for line in run.runLines(args)
+                 if line]
+    elif items is None:
+        items = json.loads(run.runCollect(args))['items']
+    run.cacheResult(args, items)
+    return items
+
+def get_item(kind: str, name: str,
+             namespace: str = "") -> Optional[dict[str, Any]]:
+    if api:
+        try:
+            return api.get(kind, name, namespace)
+        except api_errors:
+            pass
+    r = run.runTry(kubectl_get(kind, namespace, name))
+    return json.loads(r.stdout) if r.returncode == 0 else None
+
+def delete_item(kind: str, name: str, namespace: str = "",
+                grace_period: Optional[int] = None) -> bool:
+    run.invalidateCache(kind, namespace)
+    if api:
+        try:
+            return api.delete(kind, name, namespace, grace_period)
+        except api_errors:
+            pass
+    args = ['kubectl', 'delete', kind, name, '--ignore-not-found=true',
+            '--wait=false']
+    if namespace:
+        args += ['-n', namespace]
+    if grace_period is not None:
+        args.append(f'--grace-period={grace_period}')
+    return run.runTry(args).returncode == 0
+
+# Delete every object of the kind in the namespace, or just those matching
+# selector, a request each over the one connection. Like the deletes above,
+# this doesn't wait for them to go. Returns their names.
+def delete_items(kind: str, namespace: str, selector: str = "",
+                 grace_period: Optional[int] = None) -> list[str]:
+    run.invalidateCache(kind, namespace) # we must see all there is
+    names = [item['metadata']['name']
+             for item in list_items(kind, namespace, selector,
+                                    metadata_only=True)]
+    for name in names:
+        delete_item(kind, name, namespace, grace_period)
+    return names
@@ -0,0 +1,99 @@
+import os
+import json
+import hashlib
+import threading
+from typing import Any, Optional
+
+import yaml # type: ignore
+
+#
+# What we've applied to the cluster from our templates, so that we can skip
+# objects that haven't changed without asking the API server. Every object we
+# apply carries a hash of its content in an annotation, and we keep the same
+# hashes locally, per cluster, by namespace and by the template (the source)
+# each object came from. The record also tells us what to delete when a
+# template's objects are torn down.
+#
+
+hash_annotation = 'bigbang.hazelcast.net/content-hash'
+
+lock = threading.Lock()
+storef = ""
+cluster = ""
+# namespace -> source -> objects as {'kind', 'name', 'hash'}
+applied: dict[str, dict[str, list[dict[str, str]]]] = {}
+
+# The record lives in storef, and only holds for the cluster named. Pointing
+# at a different cluster (such as a new one, after a stop and start) forgets
+# everything.
+def configure(new_storef: str, new_cluster: str) -> None:
+    global storef, cluster, applied
+    with lock:
+        storef, cluster, applied = new_storef, new_cluster, {}
+        try:
+            with open(storef) as fh:
+                saved = json.load(fh)
+            if saved.get('cluster') == cluster:
+                applied = saved['applied']
+        except (OSError, ValueError, KeyError):
+            pass
+
+# Must be called with lock held
+def save() -> None:
+    if not storef:
+        return
+    tmpf = storef + '.tmp'
+    with open(tmpf, 'w') as fh:
+        json.dump({'cluster': cluster, 'applied': applied}, fh)
+    os.replace(tmpf, storef)
+
+def content_hash(obj: dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(obj, sort_keys=True).encode()) \
+            .hexdigest()[:32]
+
+# The objects in a rendered template which need applying: those we haven't
+# applied to this cluster before with the same content. They come back with
+# their hash annotation in place.
+def prepare(source: str, namespace: str, rendered: str) -> list[dict[str, Any]]:
+    with lock:
+        known = {(o['kind'], o['name'], o['hash'])
+                 for o in applied.get(namespace, {}).get(source, [])}
+    changed = []
+    for obj in yaml.safe_load_all(rendered):
+        if not obj:
+            continue
+        h = content_hash(obj)
+        if (obj['kind'], obj['metadata']['name'], h) in known:
+            continue
+        annotations = obj['metadata'].setdefault('annotations', {})
+        annotations[hash_annotation] = h
+        changed.append(obj)
+    return changed
+
+# Call once objects from prepare have been applied
+def record(source: str, namespace: str, objs: list[dict[str, Any]]) -> None:
+    with lock:
+        entries = applied.setdefault(namespace, {}).setdefault(source, [])
+        for obj in objs:
+            kind, name = obj['kind'], obj['metadata']['name']
+            entries[:] = [e for e in entries
+                          if (e['kind'], e['name']) != (kind, name)]
+            entries.append({'kind': kind, 'name': name,
+                            'hash': obj['metadata']['annotations']
+                                       [hash_annotation]})
+        save()
+
+# Kind and name of what we applied from the given source
+def objects(source: str, namespace: str) -> list[tuple[str, str]]:
+    with lock:
+        return [(e['kind'], e['name'])
+                for e in applied.get(namespace, {}).get(source, [])]
+
+# Forget what we applied from one source, or all of a namespace
+def forget(namespace: str, source: Optional[str] = None) -> None:
+    with lock:
+        if source is None:
+            applied.pop(namespace, None)
+        else:
+            applied.get(namespace, {}).pop(source, None)
+        save()
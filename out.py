@@ -1,9 +1,13 @@
 import time
 import textwrap
+import threading
 from termcolor import cprint, colored # type: ignore
-from typing import Callable
+from typing import Callable, Optional
 from shutil import get_terminal_size
 
+# local imports
+import durations
+
 #
 # Important announcements to the user!
 #
@@ -20,8 +24,9 @@ def announceSqlEnd(s: str) -> None:
 def announce(s: str) -> None:
     cprint(f'==> {s}', 'blue', attrs = ['bold'])
 
-def announceStart(s: str) -> None:
-    cprint(f'--> ⬇︎ ⟦{s}⟧ START ⬇︎', 'cyan', attrs = ['bold'])
+def announceStart(s: str, estimate: Optional[float] = None) -> None:
+    est = f' (usually {durations.format_eta(estimate)})' if estimate else ''
+    cprint(f'--> ⬇︎ ⟦{s}⟧ START{est} ⬇︎', 'cyan', attrs = ['bold'])
 
 def announceEnd(s: str, tinterv: float) -> None:
     ts = time.strftime("%Mm%Ss", time.gmtime(tinterv))
@@ -62,51 +67,149 @@ def announceBox(s: str) -> None:
         cp(bl + line.ljust(maxl) + br)
     cp(botbord)
 
-def spinWait(waitFunc: Callable[[], float]) -> None:
-    ls = ' '
-    lb = '┠'
-    rb = '┨'
-    anim1 = ['⣾', '⣽', '⣻', '⢿', '⡿', '⣟', '⣯', '⣷']
-    anim2 = ['⣷', '⣯', '⣟', '⡿', '⢿', '⣻', '⣽', '⣾']
-    bs = len(ls) + len(anim1[0]) + len(lb) + len(rb) + len(anim2[0])
-    maxlen = 0
+# Runs a progress probe on its own thread, so that a slow probe can't freeze
+# the progress meter and a fast one doesn't hammer whatever it's probing.
+# Probes quickly at first, backs off while the ratio isn't moving, and speeds
+# back up as soon as it moves again.
+class Probe:
+    min_interval = 0.25 # seconds
+    max_interval = 8.0
+
+    def __init__(self, waitFunc: Callable[[], float]):
+        self.waitFunc = waitFunc
+        self.ratio = 0.0
+        self.error: Optional[Exception] = None
+        self.done = threading.Event() # finished, one way or another
+        self.stopped = threading.Event() # nobody cares any more
+        self.thread = threading.Thread(target=self.__probe_thread,
+                                       daemon=True)
+        self.thread.start()
+
+    def __probe_thread(self) -> None:
+        interval = self.min_interval
+        while not self.stopped.is_set():
+            try:
+                ratio = self.waitFunc()
+                assert ratio <= 1.0, f'progress ratio {ratio} is over 1.0'
+            except Exception as e: # including a bad ratio
+                self.error = e
+                break
+            if ratio != self.ratio:
+                interval = self.min_interval
+            else:
+                interval = min(interval * 2, self.max_interval)
+            self.ratio = ratio
+            if ratio == 1.0:
+                break
+            self.stopped.wait(interval)
+        self.done.set()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+# A named readiness goal: a label to show, and a function returning how close
+# to done it is, from 0.0 to 1.0
+Goal = tuple[str, Callable[[], float]]
+
+ls = ' '
+lb = '┠'
+rb = '┨'
+anim1 = ['⣾', '⣽', '⣻', '⢿', '⡿', '⣟', '⣯', '⣷']
+anim2 = ['⣷', '⣯', '⣟', '⡿', '⢿', '⣻', '⣽', '⣾']
+minpctsz = len("─1%─▶")
+
+def progressBar(pct: float, i: int, barlength: int) -> str:
     f = min(len(anim1), len(anim2))
+    c = int(pct * barlength)
+    if c == 0:
+        arrow = ""
+    elif c == 1:
+        arrow = '▶'
+    elif c < minpctsz:
+        arrow = (c - 1) * '─' + '▶'
+    else:
+        p100 = str(int(100 * pct)) + '%'
+        rmdr = c - len(p100) - 1 # 1 for arrowhead
+        left = rmdr >> 1
+        right = rmdr - left
+        arrow = left * '─' + p100 + right * '─' + '▶'
+    return ls + anim1[i % f] + lb + arrow + ' ' * (barlength - c) + \
+            rb + anim2[i % f]
+
+# Time remaining for a goal: from how long it has taken before if we know,
+# otherwise extrapolated from progress so far once there's enough of it
+def eta(phase: str, pct: float, elapsed: float) -> str:
+    if pct == 1.0:
+        return ""
+    if (est := durations.estimate(phase)) is not None:
+        return 'ETA ' + durations.format_eta(est - elapsed)
+    if pct >= 0.1:
+        return 'ETA ' + durations.format_eta(elapsed / pct - elapsed)
+    return ""
+
+# The phase name is used to learn how long this wait usually takes
+def spinWait(waitFunc: Callable[[], float], phase: str = "") -> None:
+    spinWaitMulti([(phase, waitFunc)], showLabels = False)
+
+# Wait on several goals at once, one progress meter per row. Returns once
+# every goal is done, or raises the exception of the first goal to fail. The
+# goal labels double as phase names for estimating how long each will take.
+def spinWaitMulti(goals: list[Goal], showLabels: bool = True) -> None:
+    etaw = len(" ETA 00m00s")
+    bs = len(ls) + len(anim1[0]) + len(lb) + len(rb) + len(anim2[0]) + etaw
+    labelw = max(len(label) for label, _ in goals) if showLabels else 0
+    if labelw:
+        labelw += 1 # space between label and meter
+    nrows = len(goals)
+    maxlen = 0
     barlength = None
-    minpctsz = len("─1%─▶")
+    framerate = 0.1 # seconds between redraws, independent of the probes
     def cd(x):
         return colored(x, 'red')
-    def eraseLine(flush: bool = False):
-        cprint(cd(' ' * maxlen), end = '\r', flush = flush)
+    def home(flush: bool):
+        # Back to the start of the first row, ready to redraw
+        up = f'\x1b[{nrows - 1}A' if nrows > 1 else ''
+        print('\r' + up, end = '', flush = flush)
+    def drawRows(rows: list[str], flush: bool):
+        for j, row in enumerate(rows):
+            end = '\n' if j < nrows - 1 else ''
+            print(cd(row), end = end)
+        home(flush)
+    def eraseRows(flush: bool = False):
+        drawRows([' ' * maxlen] * nrows, flush)
 
+    probes = [Probe(waitFunc) for _, waitFunc in goals]
+    start = time.time()
+    finished: set[str] = set()
     i = 0
-    pct = 0.0
-    while pct < 1.0:
-        pct = waitFunc()
-        assert pct <= 1.0
-        newbarlength = get_terminal_size(fallback = (72, 24)).columns - bs
-        if barlength and barlength != newbarlength:
-            eraseLine(flush = True)
-        barlength = newbarlength
-        c = int(pct * barlength)
-        if c == 0:
-            arrow = ""
-        elif c == 1:
-            arrow = '▶'
-        elif c < minpctsz:
-            arrow = (c - 1) * '─' + '▶'
-        else:
-            p100 = str(int(100 * pct)) + '%'
-            rmdr = c - len(p100) - 1 # 1 for arrowhead
-            left = rmdr >> 1
-            right = rmdr - left
-            arrow = left * '─' + p100 + right * '─' + '▶'
-        s = ls + anim1[i % f] + lb + arrow + ' ' * (barlength - c) + \
-                rb + anim2[i % f]
-        maxlen = max(maxlen, len(s))
-        print(cd(s), end='\r', flush=True)
-        if pct == 1.0:
-            # When we finish, erase all traces of progress meter
-            eraseLine(flush = False)
-            return
-        i += 1
-        time.sleep(0.25)
+    try:
+        while True:
+            if failed := [p.error for p in probes if p.error]:
+                eraseRows(flush = True)
+                raise failed[0]
+            newbarlength = (get_terminal_size(fallback = (72, 24)).columns -
+                            bs - labelw)
+            if barlength and barlength != newbarlength:
+                eraseRows(flush = True)
+            barlength = newbarlength
+            pcts = [p.ratio for p in probes]
+            elapsed = time.time() - start
+            rows = [(label.ljust(labelw) if showLabels else '') +
+                    progressBar(pct, i, barlength) + ' ' +
+                    eta(label, pct, elapsed).ljust(etaw - 1)
+                    for (label, _), pct in zip(goals, pcts)]
+            for (label, _), pct in zip(goals, pcts):
+                if pct == 1.0 and label not in finished:
+                    finished.add(label)
+                    durations.observe(label, elapsed)
+            maxlen = max([maxlen] + [len(r) for r in rows])
+            drawRows(rows, flush = True)
+            if all(pct == 1.0 for pct in pcts):
+                # When we finish, erase all traces of progress meters
+                eraseRows(flush = False)
+                return
+            i += 1
+            time.sleep(framerate)
+    finally:
+        for p in probes:
+            p.stop()
@@ -1,8 +1,343 @@
 #import pdb
 import json
+import time
+import threading
+from subprocess import CalledProcessError
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import requests
 
 # local imports
 import run
+import kubeapi
+from kubeapi import KubeApi
+
+#
+# Watch-based readiness. Rather than forking a kubectl for every tick of a
+# progress meter, keep a watch stream open on each kind of object we wait on
+# and maintain the current set of objects in memory. Until a kind has been
+# listed and is being watched, callers fall back to a shared snapshot.
+#
+
+watched_kinds = ('nodes', 'pods', 'deployments', 'services')
+
+def obj_key(item: dict) -> tuple[str, str]:
+    metadata = item['metadata']
+    return metadata.get('namespace', ''), metadata['name']
+
+#
+# Projection. Readiness only looks at a handful of fields of each object, so
+# we drop everything else (managedFields, annotations, most of the spec) as
+# soon as an object arrives, whether from a watch, a list or kubectl.
+#
+
+projected_metadata = ('name', 'namespace', 'labels', 'deletionTimestamp',
+                      'resourceVersion')
+
+projected_fields = {
+        'nodes':       [('spec', 'taints'), ('status', 'conditions')],
+        'pods':        [('status', 'containerStatuses')],
+        'deployments': [('spec', 'replicas'), ('status', 'readyReplicas')],
+        'services':    [('spec', 'type'), ('status', 'loadBalancer')]
+        }
+
+def project(kind: str, item: dict) -> dict:
+    metadata = item['metadata']
+    p: dict = {'metadata': {k: metadata[k] for k in projected_metadata
+                            if k in metadata}}
+    for section, field in projected_fields[kind]:
+        if (v := (item.get(section) or {}).get(field)) is not None:
+            p.setdefault(section, {})[field] = v
+    return p
+
+# When we have to fall back to kubectl, have it print just these fields, one
+# object per line, rather than the full JSON. Structured fields come out as
+# JSON; the rest as plain strings. Absent fields come out empty.
+jsonpath_columns = [('metadata', 'namespace', False),
+                    ('metadata', 'name', False),
+                    ('metadata', 'labels', True),
+                    ('metadata', 'deletionTimestamp', False),
+                    ('metadata', 'resourceVersion', False),
+                    ('spec', 'taints', True),
+                    ('spec', 'replicas', True),
+                    ('spec', 'type', False),
+                    ('status', 'conditions', True),
+                    ('status', 'containerStatuses', True),
+                    ('status', 'readyReplicas', True),
+                    ('status', 'loadBalancer', True)]
+
+def jsonpath_template() -> str:
+    cols = '{"\\t"}'.join(f'{{.{s}.{f}}}' for s, f, _ in jsonpath_columns)
+    return '{range .items[*]}{.kind}{"\\t"}' + cols + '{"\\n"}{end}'
+
+def parse_jsonpath_line(line: str) -> tuple[str, dict]:
+    kind, *values = line.split('\t')
+    item: dict = {}
+    for (section, field, structured), v in zip(jsonpath_columns, values):
+        if v:
+            item.setdefault(section, {})[field] = (json.loads(v) if structured
+                                                   else v)
+    return kind, item
+
+class ClusterWatcher:
+    def __init__(self, api: KubeApi):
+        self.api = api
+        self.lock = threading.Lock()
+        self.objects: dict[str, dict[tuple[str, str], dict]] = {
+                kind: {} for kind in watched_kinds
+                }
+        self.synced: set[str] = set()
+        # kinds changed by us since they were last listed, which the watch
+        # may not have caught up with
+        self.stale: set[str] = set()
+        self.resyncs = 0 # times we've been told of such a change
+        self.streams: dict[str, requests.Response] = {} # open watches
+        self.interrupted: set[str] = set() # kinds whose watch we cut off
+        self.terminate = False
+        self.threads = [threading.Thread(target=self.__watch_forever_thread,
+                                         args=(kind,), daemon=True)
+                        for kind in watched_kinds]
+
+    def start(self) -> None:
+        for t in self.threads:
+            t.start()
+
+    def stop(self) -> None:
+        self.terminate = True
+        with self.lock:
+            self.synced.clear()
+        self.api.close()
+
+    def is_synced(self, kind: str) -> bool:
+        with self.lock:
+            return kind in self.synced
+
+    # We've just changed the cluster, and until we've listed again we can't
+    # tell whether the watch has seen the change. Readers fall back to the
+    # snapshot meanwhile. Watches can go minutes without an event, so cut
+    # them off, to have them list again now.
+    def resync(self) -> None:
+        with self.lock:
+            self.resyncs += 1
+            self.stale.update(watched_kinds)
+            self.interrupted.update(self.streams)
+            streams = list(self.streams.values())
+        for r in streams:
+            kubeapi.interrupt(r)
+
+    def __opened(self, kind: str, r: requests.Response) -> None:
+        with self.lock:
+            self.streams[kind] = r
+            if stale := kind in self.stale: # since we checked
+                self.interrupted.add(kind)
+        if stale:
+            kubeapi.interrupt(r)
+
+    def items(self, kind: str, namespace: str = "") -> Optional[list[dict]]:
+        with self.lock:
+            if kind not in self.synced or kind in self.stale:
+                return None
+            return [v for (ns, _), v in self.objects[kind].items()
+                    if not namespace or ns == namespace]
+
+    def __relist(self, kind: str) -> str:
+        with self.lock:
+            resyncs = self.resyncs
+        objects: dict[tuple[str, str], dict] = {}
+        for page in self.api.list_pages(kind):
+            for item in page['items']:
+                objects[obj_key(item)] = project(kind, item)
+        with self.lock:
+            self.objects[kind] = objects
+            self.synced.add(kind)
+            # A change made while we listed may or may not be in the list,
+            # so we're only up to date if there wasn't one
+            if self.resyncs == resyncs:
+                self.stale.discard(kind)
+        return page['metadata']['resourceVersion']
+
+    def is_stale(self, kind: str) -> bool:
+        with self.lock:
+            return kind in self.stale
+
+    def __watch_forever_thread(self, kind: str) -> None:
+        while not self.terminate:
+            try:
+                rv = self.__relist(kind)
+                while not self.terminate:
+                    if self.is_stale(kind):
+                        rv = self.__relist(kind)
+                    for event in self.api.watch(
+                            kind, rv, lambda r: self.__opened(kind, r)):
+                        etype = event['type']
+                        obj = event['object']
+                        if etype == 'ERROR':
+                            # Most likely 410 Gone: our resourceVersion is
+                            # too old, so we have to list all over again
+                            rv = self.__relist(kind)
+                            break
+                        rv = obj['metadata']['resourceVersion']
+                        if etype == 'BOOKMARK':
+                            continue
+                        with self.lock:
+                            if etype == 'DELETED':
+                                self.objects[kind].pop(obj_key(obj), None)
+                            else: # ADDED or MODIFIED
+                                self.objects[kind][obj_key(obj)] = \
+                                        project(kind, obj)
+                        if self.terminate or self.is_stale(kind):
+                            break
+                    with self.lock:
+                        self.streams.pop(kind, None)
+                        self.interrupted.discard(kind)
+            except kubeapi.api_errors + (KeyError,):
+                with self.lock:
+                    self.streams.pop(kind, None)
+                    if kind in self.interrupted:
+                        self.interrupted.discard(kind)
+                        continue # resync cut us off; list again now
+                    # Lost the stream (or never got it). Answer from
+                    # snapshots until we have re-listed.
+                    self.synced.discard(kind)
+                time.sleep(1)
+
+# There is only ever one cluster (and one tunnel) per run, so a single watcher
+# serves the whole program.
+watcher: Optional[ClusterWatcher] = None
+
+def start_watching() -> None:
+    global watcher
+    if watcher:
+        return
+    if not kubeapi.api:
+        print('No direct connection to API server; will poll instead')
+        return
+    # The watches get their own connection pool, as each holds a connection
+    # open for minutes at a time
+    watcher = ClusterWatcher(KubeApi(kubeapi.api.creds))
+    watcher.start()
+
+def stop_watching() -> None:
+    global watcher
+    if watcher:
+        watcher.stop()
+        watcher = None
+
+# Stop watching and drop our API server connections once the tunnel they run
+# through goes away
+@contextmanager
+def watching() -> Iterator[None]:
+    try:
+        yield
+    finally:
+        stop_watching()
+        kubeapi.disconnect()
+
+def watched_items(kind: str, namespace: str = "") -> Optional[list[dict]]:
+    return watcher.items(kind, namespace) if watcher else None
+
+#
+# Bulk snapshots. When we can't answer from the watcher, fetch pods,
+# deployments, services and nodes across all namespaces in a single kubectl
+# call, and serve every waiter from that one snapshot until it goes stale or
+# until we change something in the cluster ourselves.
+#
+
+snapshot_interval = 2.0 # seconds
+
+# Map the kind reported on each object in a List to our resource names
+snapshot_kinds = {'Pod':        'pods',
+                  'Deployment': 'deployments',
+                  'Service':    'services',
+                  'Node':       'nodes'}
+
+class ClusterSnapshot:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.taken = 0.0
+        self.objects: dict[str, list[dict]] = {}
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.taken = 0.0
+
+    def __refresh(self) -> None:
+        self.objects = {}
+        objects: dict[str, list[dict]] = {k: [] for k in snapshot_kinds.values()}
+        if kubeapi.api:
+            # Several requests, but over one already-open connection
+            try:
+                for kind in objects:
+                    objects[kind] = [project(kind, i)
+                                     for page in kubeapi.api.list_pages(kind)
+                                     for i in page['items']]
+                self.objects = objects
+                self.taken = time.time()
+                return
+            except kubeapi.api_errors:
+                objects = {k: [] for k in snapshot_kinds.values()}
+        kinds = ",".join(snapshot_kinds.values())
+        try:
+            for line in run.runLines(['kubectl', 'get', kinds,
+                                      '--all-namespaces',
+                                      '-ojsonpath=' + jsonpath_template()]):
+                if line:
+                    kind, item = parse_jsonpath_line(line)
+                    objects[snapshot_kinds[kind]].append(item)
+        except (CalledProcessError, ValueError):
+            return # leave the snapshot stale so the next caller retries
+        self.objects = objects
+        self.taken = time.time()
+
+    def items(self, kind: str, namespace: str = "") -> Optional[list[dict]]:
+        # Hold the lock across the refresh, so that concurrent waiters all
+        # share the one kubectl call rather than each making their own
+        with self.lock:
+            if time.time() - self.taken > snapshot_interval:
+                self.__refresh()
+            if kind not in self.objects:
+                return None
+            return [i for i in self.objects[kind] if not namespace or
+                    i['metadata'].get('namespace') == namespace]
+
+snapshot = ClusterSnapshot()
+
+# Call this after anything that changes the cluster, so that nobody waits on
+# a snapshot, or a watch, from before the change
+def invalidate() -> None:
+    snapshot.invalidate()
+    if watcher:
+        watcher.resync()
+
+# The current objects of the given kind, from the watcher if it's keeping up,
+# or else from the shared snapshot. None if the cluster couldn't be reached.
+def cluster_items(kind: str, namespace: str = "") -> Optional[list[dict]]:
+    if (items := watched_items(kind, namespace)) is not None:
+        return items
+    return snapshot.items(kind, namespace)
+
+# Only equality-based selectors (k=v[,k=v...]) are supported, as these are
+# all we use
+def selector_matches(item: dict, selector: str) -> bool:
+    labels = item['metadata'].get('labels') or {}
+    for term in selector.split(','):
+        k, _, v = term.partition('=')
+        if labels.get(k) != v:
+            return False
+    return True
+
+def pod_names(namespace: str, selector: str = "") -> list[str]:
+    pods = cluster_items('pods', namespace) or []
+    return [p['metadata']['name'] for p in pods
+            if not selector or selector_matches(p, selector)]
+
+# Pods that have been asked to go away but haven't yet; kubectl shows these
+# as 'Terminating'
+def terminating_pod_names(namespace: str) -> list[str]:
+    pods = cluster_items('pods', namespace) or []
+    return [p['metadata']['name'] for p in pods
+            if p['metadata'].get('deletionTimestamp')]
 
 def taints_are_ok(item: dict) -> bool:
     taint_ok = True
@@ -23,15 +358,7 @@ def get_nodes() -> tuple[set[str], set[str]]:
     ready_nodes: set[str] = set()
     all_nodes: set[str] = set()
 
-    r = run.runTry("kubectl get nodes -ojson".split())
-    if r.returncode != 0:
-        return ready_nodes, all_nodes
-
-    j = json.loads(r.stdout)
-    if j is None or len(j) == 0:
-        return ready_nodes, all_nodes
-
-    if not (items := j.get('items')):
+    if not (items := cluster_items('nodes')):
         return ready_nodes, all_nodes
 
     for item in items:
@@ -52,7 +379,7 @@ def get_nodes() -> tuple[set[str], set[str]]:
         if ((status := item.get('status')) and
             (conditions := status.get('conditions'))):
             for condition in conditions:
-                if ((reason := condition.get('reason')) and 
+                if ((reason := condition.get('reason')) and
                     (condstatus := condition.get('status')) and
                     reason == 'KubeletReady' and
                     condstatus == 'True'):
@@ -65,15 +392,11 @@ def get_ready_nodes() -> set[str]:
     return get_nodes()[0]
 
 def summarize_containers(namespace: str = "") -> tuple[set[str], set[str]]:
-    namesp = f" --namespace {namespace}" if namespace else ""
     readyc: set[str] = set()
     allc: set[str] = set()
 
     try:
-        j = json.loads(run.runCollect(f'kubectl{namesp} '
-                                      'get pods -ojson'.split()))
-
-        for item in j['items']:
+        for item in cluster_items('pods', namespace) or []:
             metadata = item['metadata']
 
             podname = metadata['name']
@@ -95,3 +418,21 @@ def summarize_containers(namespace: str = "") -> tuple[set[str], set[str]]:
         pass
 
     return readyc, allc
+
+# Returns the number of ready replicas and the number of desired replicas,
+# summed across all deployments in the namespace
+def summarize_deployments(namespace: str = "") -> tuple[int, int]:
+    repready = 0
+    reptotal = 0
+
+    for dep in cluster_items('deployments', namespace) or []:
+        total = dep["spec"]["replicas"]
+        numready = dep.get("status", {}).get("readyReplicas", 0)
+        assert numready <= total
+        repready += numready
+        reptotal += total
+
+    return repready, reptotal
+
+def list_services(namespace: str) -> Optional[list[dict]]:
+    return cluster_items('services', namespace)
@@ -1,15 +1,180 @@
+import os
+import re
 import sys
+import asyncio
+import inspect
+import weakref
+import threading
 import subprocess
 import time
+from collections import deque
 from subprocess import CalledProcessError
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Optional
+
+# local imports
+import cmdgrp
+import cmdtrace
+
+#
+# Result cache for read-only commands. The same kubectl and helm reads come up
+# again and again in a single run, so remember their output for a while, keyed
+# by argv and kube context. Anything that changes the cluster through kubectl
+# or helm drops the cached results for the kind of resource it touches, and
+# for the namespace it touches.
+#
+
+# Read-only commands we're happy to reuse: the leading words of the command
+# (ignoring options) -> (seconds to keep the result, resource kind it reads)
+readonly_commands: dict[tuple[str, ...], tuple[float, str]] = {
+        ('kubectl', 'get', 'namespaces'):             (30.0, 'namespaces'),
+        ('kubectl', 'get', 'secrets'):                (30.0, 'secrets'),
+        ('kubectl', 'get', 'persistentvolumeclaims'): (10.0,
+                                                       'persistentvolumeclaims'),
+        ('helm', 'list'):                             (30.0, 'releases'),
+        ('helm', 'repo', 'list'):                     (300.0, 'repos'),
+        ('helm', 'version'):                          (3600.0, 'helm')
+        }
+
+# Commands from these tools that don't change anything. Everything else they
+# run is treated as a mutation.
+readonly_verbs = {'kubectl': {'get', 'describe', 'logs', 'version',
+                              'api-resources', 'explain'},
+                  'helm':    {'list', 'version', 'status', 'get', 'show',
+                              'search', 'template'}}
+
+kind_aliases = {'namespace': 'namespaces', 'ns': 'namespaces',
+                'secret': 'secrets', 'pod': 'pods',
+                'svc': 'services', 'service': 'services',
+                'pvc': 'persistentvolumeclaims',
+                'persistentvolumeclaim': 'persistentvolumeclaims'}
+
+# Options whose value is a separate argument, so it isn't mistaken for a word
+# of the command
+valued_options = {'-f', '--filename', '-l', '--selector', '-o', '--output',
+                  '--version', '--timeout', '-c', '--container'}
+
+cache_lock = threading.Lock()
+# key -> (expiry, kind, namespace, result)
+cache: dict[tuple[str, ...], tuple[float, str, str, Any]] = {}
+
+# Split a command into its positional words and the namespace it names (if
+# any), skipping over options
+def parseCommand(args) -> tuple[list[str], str]:
+    words: list[str] = []
+    namespace = ""
+    i = 0
+    while i < len(args):
+        a = args[i]
+        if a in ('-n', '--namespace') and i + 1 < len(args):
+            namespace = args[i + 1]
+            i += 1
+        elif m := re.fullmatch(r'(?:-n|--namespace=)(.+)', a):
+            namespace = m.group(1)
+        elif a in valued_options:
+            i += 1
+        elif not a.startswith('-'):
+            words.append(a)
+        i += 1
+    return words, namespace
+
+def readonlyRule(words: list[str]) -> Optional[tuple[float, str]]:
+    for prefix, rule in readonly_commands.items():
+        if tuple(words[:len(prefix)]) == prefix:
+            return rule
+    return None
+
+# Which kind of resource (and which namespace) a mutating command touches,
+# or None if the command doesn't mutate anything we cache. A kind of '*'
+# means we can't tell, so assume everything.
+def mutationTarget(args) -> Optional[tuple[str, str]]:
+    words, namespace = parseCommand(args)
+    if len(words) < 2 or words[0] not in readonly_verbs:
+        return None
+    tool, verb = words[0], words[1]
+    # Changes to the kubeconfig show up in the cache key instead
+    if verb in readonly_verbs[tool] or (tool, verb) == ('kubectl', 'config') \
+            or (tool, verb, *words[2:3]) == ('helm', 'repo', 'list'):
+        return None
+    if tool == 'helm':
+        return ('repos' if verb == 'repo' else 'releases'), namespace
+    # Objects applied from files could be of any kind
+    fromfile = any(re.match(r'-f|--filename', a) for a in args)
+    kind = '*'
+    if len(words) > 2 and not fromfile:
+        kind = kind_aliases.get(words[2], words[2])
+    if kind == 'namespaces' and len(words) > 3:
+        namespace = words[3] # everything in the namespace goes with it
+    return kind, namespace
+
+# The kube context matters to every cached result: the same command against
+# another cluster (or namespace) is a different command
+def kubeContext() -> str:
+    path = os.environ.get('KUBECONFIG', '~/.kube/config').split(':')[0]
+    path = os.path.expanduser(path)
+    try:
+        with open(path) as fh:
+            m = re.search(r'^current-context:\s*(\S+)', fh.read(), re.M)
+        return f'{path}:{os.path.getmtime(path)}:{m.group(1) if m else ""}'
+    except OSError:
+        return ""
+
+def cacheKey(args) -> tuple[str, ...]:
+    return (kubeContext(), *args)
+
+# Only commands we'd cache are looked up, so that nothing else pays for
+# reading the kubeconfig
+def cachedResult(args) -> Optional[Any]:
+    if not readonlyRule(parseCommand(args)[0]):
+        return None
+    key = cacheKey(args)
+    with cache_lock:
+        if (entry := cache.get(key)) and entry[0] > time.time():
+            return entry[3]
+    return None
+
+# Remember the result of a command, if it's one we're allowed to reuse
+def cacheResult(args, result: Any) -> None:
+    words, namespace = parseCommand(args)
+    if not (rule := readonlyRule(words)):
+        return
+    ttl, kind = rule
+    with cache_lock:
+        cache[cacheKey(args)] = (time.time() + ttl, kind, namespace, result)
+
+def invalidateCache(kind: str = '*', namespace: str = "") -> None:
+    with cache_lock:
+        for key, (_, k, n, _) in list(cache.items()):
+            if kind in ('*', k) or (namespace and namespace == n):
+                del cache[key]
 
 #
 # Some handy functions for running commands and collecting results
 #
 
+# How often a command we're waiting on checks whether the CommandGroup command
+# running it has been cancelled or run past its deadline
+cancel_poll = 0.5 # seconds
+
+# Popen.communicate, except that if we're running a CommandGroup command which
+# is cancelled or times out meanwhile, the process is killed and
+# cmdgrp.Cancelled raised. As with subprocess.run, the process is killed if
+# anything else stops us waiting, too.
+def communicate(p: subprocess.Popen,
+                input: Optional[str] = None) -> tuple[Any, Any]:
+    try:
+        while True:
+            try:
+                return p.communicate(input, timeout=cancel_poll)
+            except subprocess.TimeoutExpired:
+                cmdgrp.check_cancelled()
+    except BaseException:
+        p.kill()
+        raise
+
 # if the user specifies verbose, print the results to the screen as they come,
 # otherwise capture the results to an internal buffer
-def run(args, check = True, verbose = True) -> subprocess.CompletedProcess:
+def run(args, check = True, verbose = True,
+        input: Optional[str] = None) -> subprocess.CompletedProcess:
     if len(args) < 1:
         sys.exit("Not enough arguments were specified to tryrun")
 
@@ -17,14 +182,44 @@ def run(args, check = True, verbose = True) -> subprocess.CompletedProcess:
     if verbose:
         print(command)
 
-    return subprocess.run(args, capture_output=(not verbose), check=check,
-                          text=True)
+    if target := mutationTarget(args):
+        invalidateCache(*target)
+    elif not verbose and (cp := cachedResult(args)):
+        now = time.time()
+        cmdtrace.record(args, now, now, cp.returncode, cached=True)
+        return cp
+
+    cmdgrp.check_cancelled() # so a cancelled command stops between steps
+    start = time.time()
+    pipe = None if verbose else subprocess.PIPE
+    p = subprocess.Popen(args, stdout=pipe, stderr=pipe, text=True,
+                         stdin=None if input is None else subprocess.PIPE)
+    stdout = stderr = None
+    try:
+        with p:
+            stdout, stderr = communicate(p, input)
+    finally:
+        cmdtrace.record(args, start, time.time(), p.returncode,
+                        len(stdout or "") + len(stderr or ""))
+    cp = subprocess.CompletedProcess(args, p.returncode, stdout, stderr)
+    if check:
+        cp.check_returncode()
+    if not verbose and cp.returncode == 0:
+        cacheResult(args, cp)
+    return cp
 
 # Run a command string in a shell
 def runShell(cmd: str) -> int:
-    return subprocess.run(cmd, shell=True, executable='/bin/bash',
-                          stdout=subprocess.DEVNULL,
-                          stderr=subprocess.STDOUT).returncode
+    cmdgrp.check_cancelled()
+    start = time.time()
+    p = subprocess.Popen(cmd, shell=True, executable='/bin/bash',
+                         stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    try:
+        with p:
+            communicate(p)
+    finally:
+        cmdtrace.record(cmd.split(), start, time.time(), p.returncode)
+    return p.returncode
 
 # CheckRC==False, as we don't want to throw an exception if this fails. Just get
 # the returncode and send it back, and don't print anything out.
@@ -36,6 +231,10 @@ def runTry(args) -> subprocess.CompletedProcess:
 def runStdout(args):
     run(args, check = True, verbose = True)
 
+# CheckRC==True, feeding the command input on its stdin
+def runInput(args, input: str) -> None:
+    run(args, check = True, verbose = True, input = input)
+
 # CheckRC==True, and we are collecting output, which we'll return back
 def runCollect(args) -> str:
     return run(args, check = True, verbose = False).stdout.strip()
@@ -43,6 +242,21 @@ def runCollect(args) -> str:
 def runIgnore(args) -> None:
     run(args, check = True, verbose = False)
 
+# CheckRC==True, and we hand back the output a line at a time as it arrives,
+# so the caller never has to hold all of it in memory at once
+def runLines(args) -> Iterator[str]:
+    start = time.time()
+    nbytes = 0
+    with subprocess.Popen(args, stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL, text=True) as p:
+        assert p.stdout is not None
+        for line in p.stdout:
+            nbytes += len(line)
+            yield line.rstrip('\n')
+    cmdtrace.record(args, start, time.time(), p.returncode, nbytes)
+    if p.returncode != 0:
+        raise CalledProcessError(p.returncode, args)
+
 def retryRun(args, maxattempts: int) -> subprocess.CompletedProcess:
     attempts = 1
     stime = 1
@@ -66,3 +280,133 @@ def retryRun(args, maxattempts: int) -> subprocess.CompletedProcess:
         time.sleep(stime)
         attempts += 1
         stime <<= 1
+
+#
+# Asynchronous versions of the above, for running independent commands
+# concurrently without a thread per command. Output is handed back a line at a
+# time as it arrives rather than buffered. All commands started this way share
+# a global concurrency limit, and each can be given a timeout in seconds after
+# which it is killed and TimeoutExpired is raised.
+#
+
+max_concurrent = 8 # commands running at once across the whole program
+line_limit = 1 << 20 # longest line of output we'll accept
+errtail_lines = 50 # lines of stderr kept for error reporting
+queued_lines = 1000 # lines arunLines reads ahead of its consumer
+
+# asyncio semaphores belong to the event loop they're first used on, so keep
+# one per loop
+limiters: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop,
+                                    asyncio.Semaphore] = \
+        weakref.WeakKeyDictionary()
+
+def limiter() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    if loop not in limiters:
+        limiters[loop] = asyncio.Semaphore(max_concurrent)
+    return limiters[loop]
+
+# onLine may be a coroutine function, in which case we don't read the next
+# line until it has returned
+async def pumpLines(stream: asyncio.StreamReader,
+                    onLine: Callable[[str], Any]) -> None:
+    async for raw in stream:
+        if inspect.isawaitable(r := onLine(raw.decode(errors='replace')
+                                                 .rstrip('\n'))):
+            await r
+
+# As with run(), verbose commands print to the screen as they go. Otherwise
+# each line of stdout goes to onLine (if given), and only the tail of stderr is
+# kept, to go into any CalledProcessError. If onLine is a coroutine function,
+# the command is held up (and its timeout keeps running) while it's busy.
+async def arun(args, check: bool = True, verbose: bool = True,
+               timeout: Optional[float] = None,
+               onLine: Optional[Callable[[str], Any]] = None) -> int:
+    if len(args) < 1:
+        sys.exit("Not enough arguments were specified to arun")
+
+    errtail: deque[str] = deque(maxlen=errtail_lines)
+    nbytes = 0
+    def countLine(line: str) -> Any:
+        nonlocal nbytes
+        nbytes += len(line) + 1
+        return onLine(line) if onLine else None
+    async with limiter():
+        if verbose:
+            print(" ".join(args))
+        start = time.time()
+        stdout = subprocess.PIPE if onLine or not verbose else None
+        stderr = None if verbose else subprocess.PIPE
+        p = await asyncio.create_subprocess_exec(*args, stdout=stdout,
+                                                 stderr=stderr,
+                                                 limit=line_limit)
+        pumps = []
+        if p.stdout:
+            pumps.append(pumpLines(p.stdout, countLine))
+        if p.stderr:
+            pumps.append(pumpLines(p.stderr, errtail.append))
+        try:
+            await asyncio.wait_for(asyncio.gather(*pumps, p.wait()), timeout)
+        except asyncio.TimeoutError:
+            raise subprocess.TimeoutExpired(args, timeout or 0.0,
+                                            stderr="\n".join(errtail))
+        finally:
+            # Don't leave anything running if we timed out or were cancelled
+            if p.returncode is None:
+                p.kill()
+                await p.wait()
+            cmdtrace.record(args, start, time.time(), p.returncode, nbytes)
+
+    assert p.returncode is not None
+    if check and p.returncode != 0:
+        raise CalledProcessError(p.returncode, args,
+                                 stderr="\n".join(errtail))
+    return p.returncode
+
+async def arunTry(args, timeout: Optional[float] = None) -> int:
+    return await arun(args, check = False, verbose = False, timeout = timeout)
+
+async def arunStdout(args, timeout: Optional[float] = None) -> None:
+    await arun(args, check = True, verbose = True, timeout = timeout)
+
+async def arunIgnore(args, timeout: Optional[float] = None) -> None:
+    await arun(args, check = True, verbose = False, timeout = timeout)
+
+# This one does hold all the output, since the caller wants it all back
+async def arunCollect(args, timeout: Optional[float] = None) -> str:
+    lines: list[str] = []
+    await arun(args, check = True, verbose = False, timeout = timeout,
+               onLine = lines.append)
+    return "\n".join(lines).strip()
+
+# Iterate over the lines of a command's output as they arrive. We read no more
+# than queued_lines ahead of the caller; past that, the command waits for the
+# caller to catch up.
+async def arunLines(args,
+                    timeout: Optional[float] = None) -> AsyncIterator[str]:
+    queue: asyncio.Queue[Optional[str]] = asyncio.Queue(maxsize=queued_lines)
+    async def produce() -> None:
+        try:
+            await arun(args, check = True, verbose = False, timeout = timeout,
+                       onLine = queue.put)
+        except asyncio.CancelledError:
+            raise # nobody's reading any more, and the queue may be full
+        except BaseException:
+            await queue.put(None)
+            raise
+        await queue.put(None)
+    task = asyncio.create_task(produce())
+    try:
+        while (line := await queue.get()) is not None:
+            yield line
+        await task # raise any CalledProcessError or TimeoutExpired
+    finally:
+        task.cancel()
+
+# Run some coroutines (say, a handful of arun* calls) concurrently from
+# synchronous code, and return their results in order. The first exception
+# raised by any of them is raised here.
+def runConcurrently(*coros: Awaitable[Any]) -> list[Any]:
+    async def gather() -> list[Any]:
+        return list(await asyncio.gather(*coros))
+    return asyncio.run(gather())
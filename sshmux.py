@@ -0,0 +1,306 @@
+import os
+import re
+import ssl
+import time
+import itertools
+import socket
+import atexit
+import tempfile
+import threading
+import subprocess
+from typing import Optional
+
+# local imports
+import cmdtrace
+
+#
+# One SSH connection to each bastion, shared by every port forward we make
+# through it. The first forward to a bastion starts an ssh ControlMaster, and
+# the rest are added to it, and removed again, with 'ssh -O forward' and
+# 'ssh -O cancel' on its control socket: no new connection, key exchange or
+# authentication each time. The master goes once its last forward does.
+#
+# Control sockets are named after our PID, so that a master left behind by a
+# run that died can be told apart from one in use by another run.
+#
+# Bringing up a master can take a while, so it's done without holding the
+# lock; whoever finishes first installs theirs, and the other is stopped.
+#
+# While there are forwards, a supervisor thread checks on them. Every
+# check_interval it makes sure each master is still running, and connects to
+# each forward's local port to make sure the bastion can still open its far
+# end, and puts back whatever has gone. Every probe_interval it also makes a
+# TLS handshake through each forward to a TLS service: the same path our own
+# traffic takes, from here to the bastion and on to the service. How long that
+# takes goes in the session trace as a sample named 'tunnel NAME handshake';
+# one that doesn't finish within probe_timeout means the forward is wedged,
+# and it's put back too. Control commands and checks aren't commands we run on
+# the cluster, so they're kept out of the command trace.
+#
+
+# How long we keep trying to bring up a master; a new bastion may accept
+# connections a little before it accepts our key
+connect_attempts = 10
+connect_poll = 0.2 # seconds between checks on whether a master is up
+
+check_interval = 2.0  # seconds between liveness checks
+probe_interval = 10.0 # seconds between probes
+probe_timeout = 5.0   # seconds to wait for a handshake through a forward
+reach_wait = 0.5      # seconds for ssh to say it couldn't open a far end
+control_timeout = 10  # seconds to wait for the master to answer ssh -O
+
+socket_prefix = 'bigbang-ssh-'
+socket_re = re.compile(re.escape(socket_prefix) + r'(\d+)-')
+socket_seq = itertools.count() # so that a replacement gets a fresh socket
+
+# keepalives, so that a dead bastion connection is noticed
+master_options = ['-o', 'ControlPersist=no',
+                  '-o', 'ExitOnForwardFailure=yes',
+                  '-o', 'ServerAliveInterval=15',
+                  '-o', 'ServerAliveCountMax=3']
+
+class Master:
+    def __init__(self, user: str, host: str):
+        self.user = user
+        self.host = host
+        self.dest = f'{user}@{host}'
+        self.socket = os.path.join(tempfile.gettempdir(),
+                                   f'{socket_prefix}{os.getpid()}-{host}-'
+                                   f'{next(socket_seq)}')
+        self.p: Optional[subprocess.Popen] = None
+        # spec -> name of the tunnel, and whether it's to a TLS service
+        self.forwards: dict[str, tuple[str, bool]] = {}
+
+    def control(self, op: str, *args: str) -> subprocess.CompletedProcess:
+        cmd = ['ssh', '-S', self.socket, '-O', op, *args, self.dest]
+        try:
+            return subprocess.run(cmd, stdin=subprocess.DEVNULL,
+                                  capture_output=True, text=True,
+                                  timeout=control_timeout)
+        except subprocess.TimeoutExpired:
+            return subprocess.CompletedProcess(cmd, 255, "",
+                                               f'ssh -O {op} timed out')
+
+    def alive(self) -> bool:
+        return (self.p is not None and self.p.poll() is None and
+                self.control('check').returncode == 0)
+
+    def start(self) -> None:
+        for attempt in range(1, connect_attempts + 1):
+            if os.path.exists(self.socket):
+                os.remove(self.socket) # stale, from a master that died
+            print(f'Connecting to {self.dest} (attempt {attempt})')
+            self.p = subprocess.Popen(['ssh', '-M', '-N', '-S', self.socket] +
+                                      master_options + [self.dest],
+                                      stdin=subprocess.DEVNULL,
+                                      stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.DEVNULL)
+            while self.p.poll() is None:
+                if self.control('check').returncode == 0:
+                    return
+                time.sleep(connect_poll)
+            time.sleep(1 << min(attempt, 4))
+        raise ConnectionError(f'Unable to connect to {self.dest}')
+
+    # Must be called with lock held
+    def add(self, spec: str) -> None:
+        cp = self.control('forward', '-L', spec)
+        if cp.returncode != 0:
+            raise ConnectionError(f'Unable to forward {spec} through '
+                                  f'{self.dest}: {cp.stderr.strip()}')
+
+    def stop(self) -> None:
+        if self.p and self.p.poll() is None:
+            self.control('exit')
+            try:
+                self.p.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.p.terminate()
+        self.p = None
+        try:
+            os.remove(self.socket) # left behind if ssh was killed
+        except FileNotFoundError:
+            pass
+
+lock = threading.Lock()
+masters: dict[str, Master] = {} # by host
+supervisor: Optional[threading.Thread] = None
+stopping = threading.Event() # set to stop the current supervisor
+
+# Must be called with lock held
+def start_supervisor() -> None:
+    global supervisor, stopping
+    if supervisor is None:
+        # A new event, as the last supervisor may not have noticed its own
+        stopping = threading.Event()
+        supervisor = threading.Thread(target=supervise, args=(stopping,),
+                                      daemon=True, name='sshmux')
+        supervisor.start()
+
+# Bring up a new master to host, and install it in place of old (None if
+# there wasn't one), carrying over old's forwards. If someone else has
+# replaced old meanwhile, theirs stays and ours goes. Returns whichever is
+# installed, or None if old was cancelled while we were connecting.
+def replace(user: str, host: str, old: Optional[Master]) -> Optional[Master]:
+    fresh = Master(user, host)
+    fresh.start() # slow, so not under the lock
+    with lock:
+        current = masters.get(host)
+        if current is not old:
+            fresh.stop()
+            return current
+        masters[host] = fresh
+        if old:
+            old.stop()
+            for spec, fwd in old.forwards.items():
+                print(f'Restoring tunnel {fwd[0]} ({spec})')
+                try:
+                    fresh.add(spec)
+                    fresh.forwards[spec] = fwd
+                except ConnectionError as e:
+                    print(e)
+        start_supervisor()
+        return fresh
+
+# spec is as for ssh -L: lport:raddr:rport. name labels the tunnel in the
+# session trace. Forwards to TLS services (tls) are probed with a handshake.
+def forward(user: str, host: str, spec: str, name: str,
+            tls: bool = False) -> Master:
+    while True:
+        with lock:
+            m = masters.get(host)
+            if m and m.alive():
+                if spec not in m.forwards:
+                    m.add(spec)
+                    m.forwards[spec] = (name, tls)
+                start_supervisor()
+                return m
+        replace(user, host, m)
+
+def cancel(host: str, spec: str) -> None:
+    with lock:
+        if not (m := masters.get(host)) or spec not in m.forwards:
+            return
+        del m.forwards[spec]
+        if m.forwards:
+            m.control('cancel', '-L', spec)
+        else:
+            m.stop()
+            del masters[host]
+        if not masters:
+            stop_supervisor()
+
+# Must be called with lock held. The supervisor notices within one check, and
+# doesn't need the lock to exit.
+def stop_supervisor() -> None:
+    global supervisor
+    stopping.set()
+    supervisor = None
+
+# Close every master we started, forwards and all
+def close_all() -> None:
+    with lock:
+        stop_supervisor()
+        for m in masters.values():
+            m.stop()
+        masters.clear()
+
+atexit.register(close_all)
+
+def lport(spec: str) -> int:
+    return int(spec.split(':')[0])
+
+# Whether a forward gets through to its far end. ssh answers on the local port
+# itself, then asks the bastion to connect to the far end, and closes our
+# connection if it can't. So nobody answering means the forward has gone, and
+# our connection being closed means it's broken.
+def reachable(spec: str) -> bool:
+    try:
+        s = socket.create_connection(('127.0.0.1', lport(spec)),
+                                     timeout=reach_wait)
+    except OSError:
+        return False
+    with s:
+        try:
+            return s.recv(1) != b''
+        except socket.timeout:
+            return True # still connected, and nothing to say until we speak
+        except OSError:
+            return False
+
+# Seconds a TLS handshake through a forward took, or None if it didn't finish
+def probe(spec: str) -> Optional[float]:
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE # we only want to know how long it takes
+    start = time.time()
+    try:
+        with socket.create_connection(('127.0.0.1', lport(spec)),
+                                      timeout=probe_timeout) as s:
+            ctx.wrap_socket(s).close()
+    except OSError: # ssl.SSLError and socket.timeout included
+        return None
+    return time.time() - start
+
+# Put back a forward on a master that's still running
+def restore(m: Master, spec: str) -> None:
+    with lock:
+        if masters.get(m.host) is not m or spec not in m.forwards:
+            return # cancelled or replaced since
+        print(f'Restoring tunnel {m.forwards[spec][0]} ({spec})')
+        m.control('cancel', '-L', spec)
+        try:
+            m.add(spec)
+        except ConnectionError as e:
+            print(e) # try again next time round
+
+# Put back the master and any forwards that have gone. Connecting through the
+# forwards takes a while, so it's done without holding the lock.
+def repair(m: Master) -> None:
+    with lock:
+        if masters.get(m.host) is not m:
+            return # cancelled or replaced since
+        running = m.p is not None and m.p.poll() is None
+        specs = list(m.forwards)
+    if running:
+        for spec in specs:
+            if not reachable(spec):
+                restore(m, spec)
+        return
+    print(f'Lost connection to {m.dest}; reconnecting')
+    replace(m.user, m.host, m)
+
+def supervise(stopping: threading.Event) -> None:
+    next_probe = time.time() + probe_interval
+    while not stopping.wait(check_interval):
+        with lock:
+            current = list(masters.values())
+        for m in current:
+            try:
+                repair(m)
+            except ConnectionError as e:
+                print(e)
+        if time.time() < next_probe:
+            continue
+        next_probe = time.time() + probe_interval
+        for m in current:
+            with lock:
+                forwards = list(m.forwards.items())
+            for spec, (name, tls) in forwards:
+                if stopping.is_set():
+                    return
+                if not tls:
+                    continue
+                if (took := probe(spec)) is not None:
+                    cmdtrace.sample(f'tunnel {name} handshake', took)
+                else:
+                    print(f'No handshake through tunnel {name} within '
+                          f'{probe_timeout}s')
+                    restore(m, spec)
+
+# PID of the run a master's command line says it belongs to, or None if it
+# isn't one of ours
+def owner(cmdline: list[str]) -> Optional[int]:
+    if (m := socket_re.search(" ".join(cmdline))) and '-M' in cmdline:
+        return int(m.group(1))
+    return None
@@ -0,0 +1,139 @@
+import os
+import json
+import glob
+import time
+import hashlib
+from typing import Any, Optional
+
+#
+# Fingerprints of what Terraform last ran against in a target directory, so
+# that we can skip the parts of a run that have nothing to do. Two are kept:
+#
+#   init:  the .tf files other than the variables file, and the provider lock
+#          file. Only these can change which providers and modules are needed.
+#   apply: every .tf file (including the variables file, and so all of our
+#          settings and our public IP), the lock file, and the serial and
+#          lineage of the state. Any apply, destroy or import bumps the serial,
+#          so a state that matches is one we left behind ourselves.
+#
+# Fingerprints live under .terraform, so that throwing that away (which forces
+# an init anyway) forgets them too.
+#
+# We also keep the outputs from the state alongside its serial and lineage, so
+# that reading them costs nothing until the state changes.
+#
+
+fingerprintf = os.path.join('.terraform', 'bigbang_fingerprint.json')
+outputsf = os.path.join('.terraform', 'bigbang_outputs.json')
+lockf = '.terraform.lock.hcl'
+statef = 'terraform.tfstate'
+
+# How long after an apply or a drift check we trust an unchanged fingerprint
+# without asking the cloud provider again
+verify_ttl = 600
+
+def read_json(path: str) -> Optional[Any]:
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+def saved(tfdir: str) -> dict[str, Any]:
+    return read_json(os.path.join(tfdir, fingerprintf)) or {}
+
+# Outputs may include secrets, so like the state itself, only the user gets to
+# read what we write
+def write_json(path: str, contents: Any) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmpf = path + '.tmp'
+    with open(os.open(tmpf, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600),
+              'w') as fh:
+        json.dump(contents, fh)
+    os.replace(tmpf, path)
+
+def save(tfdir: str, fps: dict[str, Any]) -> None:
+    write_json(os.path.join(tfdir, fingerprintf), fps)
+
+# Serial and lineage of the local state, or None if there isn't one yet
+def state_version(tfdir: str) -> Optional[tuple[int, str]]:
+    state = read_json(os.path.join(tfdir, statef))
+    if not state:
+        return None
+    return state.get('serial', 0), state.get('lineage', "")
+
+def digest(filenames: list[str], *extra: Any) -> str:
+    h = hashlib.sha256()
+    for fn in filenames:
+        h.update(os.path.basename(fn).encode())
+        try:
+            with open(fn, 'rb') as fh:
+                h.update(fh.read())
+        except FileNotFoundError:
+            h.update(b'-')
+    h.update(repr(extra).encode())
+    return h.hexdigest()
+
+def tf_files(tfdir: str) -> list[str]:
+    return sorted(glob.glob(os.path.join(tfdir, '*.tf')))
+
+# varsfile is the path of the variables file we generate into tfdir
+def init_fingerprint(tfdir: str, varsfile: str) -> str:
+    files = [f for f in tf_files(tfdir) if not os.path.samefile(f, varsfile)]
+    return digest(files + [os.path.join(tfdir, lockf)])
+
+def apply_fingerprint(tfdir: str) -> str:
+    return digest(tf_files(tfdir) + [os.path.join(tfdir, lockf)],
+                  state_version(tfdir))
+
+def needs_init(tfdir: str, varsfile: str) -> bool:
+    if not os.path.isdir(os.path.join(tfdir, '.terraform', 'providers')):
+        return True
+    return saved(tfdir).get('init') != init_fingerprint(tfdir, varsfile)
+
+def record_init(tfdir: str, varsfile: str) -> None:
+    fps = saved(tfdir)
+    fps['init'] = init_fingerprint(tfdir, varsfile)
+    save(tfdir, fps)
+
+def needs_apply(tfdir: str) -> bool:
+    return (state_version(tfdir) is None or
+            saved(tfdir).get('apply') != apply_fingerprint(tfdir))
+
+# Whether an unchanged configuration was applied or checked for drift
+# recently enough that we needn't check again
+def recently_verified(tfdir: str) -> bool:
+    return time.time() - saved(tfdir).get('verified', 0) < verify_ttl
+
+# Call after a successful apply, or a drift check that found nothing
+def record_apply(tfdir: str) -> None:
+    fps = saved(tfdir)
+    fps['apply'] = apply_fingerprint(tfdir)
+    fps['verified'] = time.time()
+    save(tfdir, fps)
+
+# The output of 'terraform output -json' as of the current state, or None if
+# we don't have it
+def cached_outputs(tfdir: str) -> Optional[dict[str, Any]]:
+    if (version := state_version(tfdir)) is None:
+        return None
+    cached = read_json(os.path.join(tfdir, outputsf))
+    if not cached or cached.get('version') != list(version):
+        return None
+    return cached['outputs']
+
+# version is the state version from before the outputs were read, so that if
+# the state changed while we were reading, we miss next time rather than
+# cache stale outputs
+def cache_outputs(tfdir: str, version: Optional[tuple[int, str]],
+                  outputs: dict[str, Any]) -> None:
+    if version is not None:
+        write_json(os.path.join(tfdir, outputsf),
+                   {'version': list(version), 'outputs': outputs})
+
+def forget(tfdir: str) -> None:
+    for fn in (fingerprintf, outputsf):
+        try:
+            os.remove(os.path.join(tfdir, fn))
+        except FileNotFoundError:
+            pass
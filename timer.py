@@ -1,5 +1,6 @@
 import time
 import out
+import durations
 
 class Timer:
     def __init__(self, descr: str):
@@ -7,10 +8,13 @@ class Timer:
         self.descr = descr
 
     def __enter__(self):
-        out.announceStart(self.descr)
+        out.announceStart(self.descr, durations.estimate(self.descr))
         return self
 
-    def __exit__(self, *args):
+    def __exit__(self, exc_type, *args):
         self.end = time.time()
         self.interval = self.end - self.start
         out.announceEnd(self.descr, self.interval)
+        # Only learn from phases that ran to completion
+        if exc_type is None:
+            durations.observe(self.descr, self.interval)